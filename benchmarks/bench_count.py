@@ -0,0 +1,38 @@
+""" Counting rows: fetching them all and taking len(), against count()
+and estimate_count(), which leave the rows on the server.
+"""
+import asyncio
+
+from util import make_parser, generate_module, timed
+
+
+DDL = '''\
+DROP TABLE IF EXISTS bench_count;
+CREATE TABLE bench_count(
+    id SERIAL PRIMARY KEY,
+    name TEXT,
+    value INTEGER
+);
+'''
+
+
+async def main(args):
+    generated = await generate_module(args, DDL)
+    table = generated.bench_count
+    await table.create_many([dict(name='x', value=i) for i in range(args.rows)])
+    await generated.pool.execute('ANALYZE bench_count')
+
+    with timed('len(read_many())', args.rows):
+        len(await table.read_many())
+
+    with timed('count()', args.rows):
+        await table.count()
+
+    with timed('estimate_count()', args.rows):
+        await table.estimate_count()
+
+    await generated.pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(make_parser(__doc__).parse_args()))
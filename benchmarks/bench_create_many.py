@@ -0,0 +1,39 @@
+""" Per-row ``create()`` against the bulk ``create_many()`` paths. """
+import asyncio
+import datetime
+
+from util import make_parser, generate_module, timed
+
+
+DDL = '''\
+DROP TABLE IF EXISTS bench_create_many;
+CREATE TABLE bench_create_many(
+    id SERIAL PRIMARY KEY,
+    name TEXT,
+    value INTEGER,
+    created_at TIMESTAMP
+);
+'''
+
+
+async def main(args):
+    generated = await generate_module(args, DDL)
+    table = generated.bench_create_many
+    now = datetime.datetime.utcnow()
+    rows = [dict(name=f'row {i}', value=i, created_at=now) for i in range(args.rows)]
+
+    with timed('create() per row', args.rows):
+        for row in rows:
+            await table.create(**row)
+
+    with timed('create_many() via COPY', args.rows):
+        await table.create_many(rows)
+
+    with timed('create_many(returning=True)', args.rows):
+        await table.create_many(rows, returning=True)
+
+    await generated.pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(make_parser(__doc__).parse_args()))
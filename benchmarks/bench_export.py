@@ -0,0 +1,70 @@
+""" Peak RSS and time for exporting a table as JSON lines with
+read_many() and json() per row, versus export(fmt='jsonl'), and for
+export() in csv and binary.
+
+Each mode runs in its own process so that ru_maxrss is its own peak.
+"""
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from util import make_parser, generate_module
+
+
+COLUMNS = 10
+DDL = '''\
+CREATE TABLE IF NOT EXISTS bench_export(
+    id SERIAL PRIMARY KEY,
+    {}
+);
+'''.format(',\n    '.join(f'col_{i} INTEGER' for i in range(COLUMNS)))
+
+MODES = ['read_many', 'jsonl', 'csv', 'binary']
+
+
+async def measure(args):
+    generated = await generate_module(args, DDL)
+    table = generated.bench_export
+    path = os.path.join(tempfile.mkdtemp(), 'export')
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    if args.mode == 'read_many':
+        with open(path, 'w') as f:
+            for row in await table.read_many():
+                f.write(row.json() + '\n')
+    else:
+        await table.export(output=path, fmt=args.mode)
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{args.mode:<10} {os.path.getsize(path) / 2**20:8.1f} MiB {elapsed:8.3f}s '
+          f'peak RSS +{(peak - baseline) / 1024:8.1f} MiB')
+    await generated.pool.close()
+
+
+async def load(args):
+    generated = await generate_module(args, 'DROP TABLE IF EXISTS bench_export;\n' + DDL)
+    row = {f'col_{i}': i for i in range(COLUMNS)}
+    await generated.bench_export.create_many([row] * args.rows)
+    await generated.pool.close()
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--mode', choices=MODES)
+    parser.set_defaults(rows=1000000)
+    args = parser.parse_args()
+    if args.mode:
+        asyncio.run(measure(args))
+        return
+
+    asyncio.run(load(args))
+    for mode in MODES:
+        subprocess.run([sys.executable, __file__, '--mode', mode] + sys.argv[1:], check=True)
+
+
+if __name__ == '__main__':
+    main()
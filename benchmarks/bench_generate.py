@@ -0,0 +1,52 @@
+""" Time code generation for a synthetic schema with many tables.
+
+Compares the emitted code as-is, yapf over each table on a process pool
+(--format) and yapf over the whole output in one call, as the generator
+used to do.
+"""
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import asyncpg
+
+import pg_crud_gen
+from bench_introspection import SCHEMA, create_schema, drop_schema
+from util import make_parser, dsn
+
+
+async def main(args):
+    conn = await asyncpg.connect(dsn(args))
+    await create_schema(conn, args.tables)
+    await conn.close()
+
+    pool = await asyncpg.create_pool(dsn(args), min_size=1, max_size=4)
+    outfile = os.path.join(tempfile.mkdtemp(), 'bench_generated.py')
+
+    for label, fmt in [('pre-formatted', False), (f'--format, {args.jobs or os.cpu_count()} jobs', True)]:
+        gen_args = SimpleNamespace(
+            schema=SCHEMA, outfile=outfile, no_cache=True, format=fmt, jobs=args.jobs
+        )
+        t0 = time.perf_counter()
+        await pg_crud_gen.generate(pool, gen_args)
+        print(f'{label:<28} {time.perf_counter() - t0:8.3f}s')
+
+    # The previous behaviour: one yapf pass over the whole file.
+    with open(outfile) as f:
+        src = f.read()
+    t0 = time.perf_counter()
+    pg_crud_gen.format_code(src)
+    print(f'{"yapf, whole file":<28} {time.perf_counter() - t0:8.3f}s')
+
+    async with pool.acquire() as conn:
+        await drop_schema(conn)
+    await pool.close()
+
+
+if __name__ == '__main__':
+    parser = make_parser(__doc__)
+    parser.add_argument('--tables', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=None)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,47 @@
+""" Cost of the instrumentation hooks on read(): no hook registered,
+and a LatencyHistogram registered as after hook.
+"""
+import asyncio
+
+from util import make_parser, generate_module, timed
+
+
+DDL = '''\
+DROP TABLE IF EXISTS bench_hooks;
+CREATE TABLE bench_hooks(
+    id SERIAL PRIMARY KEY,
+    name TEXT
+);
+'''
+
+
+async def reads(table, pks):
+    for pk in pks:
+        await table.read(id=pk)
+
+
+async def main(args):
+    generated = await generate_module(args, DDL)
+    table = generated.bench_hooks
+    rows = await table.create_many([dict(name='x')] * 1000, returning=True)
+    pks = [rows[i % len(rows)].id for i in range(args.rows)]
+    await reads(table, pks[:1000])  # warm up
+
+    with timed('no hooks', args.rows):
+        await reads(table, pks)
+
+    histogram = generated.LatencyHistogram()
+    generated.add_hooks(after=histogram)
+    with timed('LatencyHistogram', args.rows):
+        await reads(table, pks)
+    generated.remove_hooks(after=histogram)
+
+    with timed('no hooks, again', args.rows):
+        await reads(table, pks)
+
+    print(histogram.summary())
+    await generated.pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(make_parser(__doc__).parse_args()))
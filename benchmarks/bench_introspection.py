@@ -0,0 +1,94 @@
+""" Time schema introspection on a synthetic schema with many tables.
+
+Compares introspect() over a small pool with the information_schema
+queries the generator used before, run one after the other on a single
+connection.
+"""
+import asyncio
+import time
+from types import SimpleNamespace
+
+import asyncpg
+
+import pg_crud_gen
+from util import make_parser, dsn
+
+
+SCHEMA = 'bench_catalog'
+
+LEGACY_QUERIES = [
+    '''\
+    SELECT  *
+    FROM    INFORMATION_SCHEMA.TABLES t
+             LEFT JOIN INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
+                     ON tc.table_catalog = t.table_catalog
+                     AND tc.table_schema = t.table_schema
+                     AND tc.table_name = t.table_name
+                     AND tc.constraint_type = 'PRIMARY KEY'
+             LEFT JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
+                     ON kcu.table_catalog = tc.table_catalog
+                     AND kcu.table_schema = tc.table_schema
+                     AND kcu.table_name = tc.table_name
+                     AND kcu.constraint_name = tc.constraint_name
+    WHERE   t.table_schema NOT IN ('pg_catalog', 'information_schema')
+    ''',
+    f'''\
+    SELECT * FROM information_schema.columns
+    WHERE table_schema = '{SCHEMA}'
+    ORDER BY table_name, ordinal_position
+    ''',
+]
+
+
+async def drop_schema(conn):
+    # Dropping thousands of tables in one transaction runs out of locks.
+    names = await conn.fetch(
+        'SELECT tablename FROM pg_tables WHERE schemaname = $1', SCHEMA
+    )
+    for i in range(0, len(names), 100):
+        await conn.execute('DROP TABLE {}'.format(
+            ', '.join(f'{SCHEMA}.{r["tablename"]}' for r in names[i:i + 100])
+        ))
+    await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA}')
+
+
+async def create_schema(conn, tables: int):
+    await drop_schema(conn)
+    await conn.execute(f'CREATE SCHEMA {SCHEMA}')
+    columns = ',\n'.join(f'col_{i} TEXT' for i in range(10))
+    for t in range(tables):
+        await conn.execute(f'''\
+            CREATE TABLE {SCHEMA}.table_{t}(
+                id SERIAL PRIMARY KEY,
+                {columns}
+            );
+            CREATE INDEX ON {SCHEMA}.table_{t} (col_0);
+        ''')
+
+
+async def main(args):
+    conn = await asyncpg.connect(dsn(args))
+    await create_schema(conn, args.tables)
+
+    t0 = time.perf_counter()
+    for sql in LEGACY_QUERIES:
+        await conn.fetch(sql)
+    print(f'information_schema, sequential   {time.perf_counter() - t0:8.3f}s')
+    await conn.close()
+
+    gen_args = SimpleNamespace(schema=SCHEMA, db=args.db)
+    pool = await asyncpg.create_pool(dsn(args), min_size=4, max_size=4)
+    t0 = time.perf_counter()
+    tables, _ = await pg_crud_gen.introspect(pool, gen_args)
+    print(f'introspect(), pg_catalog on pool  {time.perf_counter() - t0:8.3f}s'
+          f'  ({len(tables)} tables)')
+
+    async with pool.acquire() as conn:
+        await drop_schema(conn)
+    await pool.close()
+
+
+if __name__ == '__main__':
+    parser = make_parser(__doc__)
+    parser.add_argument('--tables', type=int, default=3000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,77 @@
+""" Time generating code for many schemas.
+
+Compares one main() call per schema, each with its own pool, as when
+running the tool once per schema, with a single main() call given a
+glob that matches all of them.
+"""
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import asyncpg
+
+import pg_crud_gen
+from util import make_parser, dsn
+
+
+PREFIX = 'bench_multi_'
+
+
+async def create_schemas(conn, schemas: int, tables: int):
+    await drop_schemas(conn)
+    columns = ',\n'.join(f'col_{i} TEXT' for i in range(10))
+    for s in range(schemas):
+        await conn.execute(f'CREATE SCHEMA {PREFIX}{s}')
+        for t in range(tables):
+            await conn.execute(f'''\
+                CREATE TABLE {PREFIX}{s}.table_{t}(
+                    id SERIAL PRIMARY KEY,
+                    {columns}
+                )
+            ''')
+
+
+async def drop_schemas(conn):
+    names = await conn.fetch(
+        'SELECT nspname FROM pg_namespace WHERE nspname LIKE $1', PREFIX + '%'
+    )
+    for r in names:
+        await conn.execute(f'DROP SCHEMA {r["nspname"]} CASCADE')
+
+
+async def main(args):
+    conn = await asyncpg.connect(dsn(args))
+    await create_schemas(conn, args.schemas, args.tables)
+    await conn.close()
+
+    outdir = tempfile.mkdtemp()
+
+    def gen_args(schema, **kwargs):
+        return SimpleNamespace(
+            db=args.db, schema=schema, user=args.user, password=args.password,
+            host=args.host, port=args.port, no_cache=True,
+            outfile=os.path.join(outdir, '{schema}.py'), **kwargs
+        )
+
+    t0 = time.perf_counter()
+    for s in range(args.schemas):
+        await pg_crud_gen.main(gen_args(f'{PREFIX}{s}'))
+    print(f'one run per schema         {time.perf_counter() - t0:8.3f}s')
+
+    t0 = time.perf_counter()
+    await pg_crud_gen.main(gen_args(PREFIX + '*', concurrency=args.concurrency))
+    print(f'one run, concurrency {args.concurrency:<4}  {time.perf_counter() - t0:8.3f}s')
+
+    conn = await asyncpg.connect(dsn(args))
+    await drop_schemas(conn)
+    await conn.close()
+
+
+if __name__ == '__main__':
+    parser = make_parser(__doc__)
+    parser.add_argument('--schemas', type=int, default=40)
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,51 @@
+""" Following a many-to-one relation for every row of a table.
+
+Compares awaiting the accessor on each row, which reads the parent with
+one query per row (N+1 queries), with prefetch() first, which loads all
+parents in one query.
+"""
+import asyncio
+
+from util import make_parser, generate_module, timed
+
+
+DDL = '''\
+DROP TABLE IF EXISTS bench_child;
+DROP TABLE IF EXISTS bench_parent;
+CREATE TABLE bench_parent(
+    id SERIAL PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE bench_child(
+    id SERIAL PRIMARY KEY,
+    parent_id INTEGER REFERENCES bench_parent(id)
+);
+'''
+
+
+async def main(args):
+    generated = await generate_module(args, DDL)
+    parent, child = generated.bench_parent, generated.bench_child
+    parents = await parent.create_many(
+        [dict(name=str(i)) for i in range(args.rows // 10)], returning=True
+    )
+    await child.create_many(
+        [dict(parent_id=parents[i % len(parents)].id) for i in range(args.rows)]
+    )
+
+    children = await child.read_many()
+    with timed('accessor per row (N+1)', args.rows):
+        for c in children:
+            await c.parent()
+
+    children = await child.read_many()
+    with timed('prefetch(), then accessor', args.rows):
+        await generated.prefetch(children, 'parent')
+        for c in children:
+            await c.parent()
+
+    await generated.pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(make_parser(__doc__).parse_args()))
@@ -0,0 +1,66 @@
+""" Peak RSS and time for getting a numeric table as columns: read_many()
+and transposing the instances, versus read_columns(), as lists and as
+NumPy arrays.
+
+Each mode runs in its own process so that ru_maxrss is its own peak.
+"""
+import asyncio
+import resource
+import subprocess
+import sys
+import time
+
+from util import make_parser, generate_module
+
+
+COLUMNS = 10
+DDL = '''\
+CREATE TABLE IF NOT EXISTS bench_columns(
+    id SERIAL PRIMARY KEY,
+    {}
+);
+'''.format(',\n    '.join(f'col_{i} DOUBLE PRECISION' for i in range(COLUMNS)))
+
+MODES = ['transpose', 'lists', 'numpy']
+
+
+async def measure(args):
+    generated = await generate_module(args, DDL)
+    table = generated.bench_columns
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    if args.mode == 'transpose':
+        rows = await table.read_many()
+        columns = {c: [getattr(r, c) for r in rows] for c in table._columns}
+    else:
+        columns = await table.read_columns(numpy=args.mode == 'numpy')
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{args.mode:<10} {len(columns["id"]):>10,} rows {elapsed:8.3f}s '
+          f'peak RSS +{(peak - baseline) / 1024:8.1f} MiB')
+    await generated.pool.close()
+
+
+async def load(args):
+    generated = await generate_module(args, 'DROP TABLE IF EXISTS bench_columns;\n' + DDL)
+    row = {f'col_{i}': i / 3 for i in range(COLUMNS)}
+    await generated.bench_columns.create_many([row] * args.rows)
+    await generated.pool.close()
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--mode', choices=MODES)
+    parser.set_defaults(rows=1000000)
+    args = parser.parse_args()
+    if args.mode:
+        asyncio.run(measure(args))
+        return
+
+    asyncio.run(load(args))
+    for mode in MODES:
+        subprocess.run([sys.executable, __file__, '--mode', mode] + sys.argv[1:], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+""" Rows per second for read_many() on a narrow and a wide table.
+
+Besides the full read_many(), the rows it fetched are turned into
+instances again with the keyword ``cls(**record)`` path that read_many()
+used before, and with the positional ``_from_record()`` path it uses now.
+"""
+import asyncio
+
+from util import make_parser, generate_module, timed
+
+
+WIDE_COLUMNS = 40
+DDL = '''\
+DROP TABLE IF EXISTS bench_narrow;
+DROP TABLE IF EXISTS bench_wide;
+CREATE TABLE bench_narrow(
+    id SERIAL PRIMARY KEY,
+    name TEXT,
+    value INTEGER
+);
+CREATE TABLE bench_wide(
+    id SERIAL PRIMARY KEY,
+    {}
+);
+'''.format(',\n    '.join(f'col_{i} INTEGER' for i in range(WIDE_COLUMNS)))
+
+
+async def bench(generated, table, rows: int):
+    name = table.__name__
+    await generated.pool.execute(f'TRUNCATE {table._table}')
+    await table.create_many([{}] * rows)
+
+    with timed(f'{name}: read_many()', rows):
+        await table.read_many()
+
+    records = await generated.pool.fetch(f'SELECT * FROM {table._table}')
+
+    with timed(f'{name}: cls(**record)', rows):
+        [table(**r) for r in records]
+
+    with timed(f'{name}: _from_record(record)', rows):
+        [table._from_record(r) for r in records]
+
+
+async def main(args):
+    generated = await generate_module(args, DDL)
+    await bench(generated, generated.bench_narrow, args.rows)
+    await bench(generated, generated.bench_wide, args.rows)
+    await generated.pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(make_parser(__doc__).parse_args()))
@@ -0,0 +1,58 @@
+""" Peak RSS and time for read_many() returning instances versus
+read_many(as_view=True) returning record-backed views.
+
+Each mode runs in its own process so that ru_maxrss is its own peak.
+"""
+import asyncio
+import resource
+import subprocess
+import sys
+import time
+
+from util import make_parser, generate_module
+
+
+COLUMNS = 20
+DDL = '''\
+CREATE TABLE IF NOT EXISTS bench_views(
+    id SERIAL PRIMARY KEY,
+    {}
+);
+'''.format(',\n    '.join(f'col_{i} INTEGER' for i in range(COLUMNS)))
+
+
+async def measure(args):
+    generated = await generate_module(args, DDL)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    rows = await generated.bench_views.read_many(as_view=args.mode == 'views')
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{args.mode:<10} {len(rows):>10,} rows {elapsed:8.3f}s '
+          f'peak RSS +{(peak - baseline) / 1024:8.1f} MiB')
+    await generated.pool.close()
+
+
+async def load(args):
+    generated = await generate_module(args, 'DROP TABLE IF EXISTS bench_views;\n' + DDL)
+    row = {f'col_{i}': i for i in range(COLUMNS)}
+    await generated.bench_views.create_many([row] * args.rows)
+    await generated.pool.close()
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--mode', choices=['instances', 'views'])
+    parser.set_defaults(rows=1000000)
+    args = parser.parse_args()
+    if args.mode:
+        asyncio.run(measure(args))
+        return
+
+    asyncio.run(load(args))
+    for mode in ('instances', 'views'):
+        subprocess.run([sys.executable, __file__, '--mode', mode] + sys.argv[1:], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+""" Cost of update() on a wide table.
+
+The first timing replaces the pool with one whose connections do
+nothing, so it measures only the Python side of building the statement.
+Run this at an older commit to compare against the per-call string
+building it replaced.
+"""
+import asyncio
+
+from util import make_parser, generate_module, timed
+
+
+COLUMNS = 40
+DDL = '''\
+DROP TABLE IF EXISTS bench_update;
+CREATE TABLE bench_update(
+    id SERIAL PRIMARY KEY,
+    {}
+);
+'''.format(',\n    '.join(f'col_{i} TEXT' for i in range(COLUMNS)))
+
+
+class NullConnection:
+    async def execute(self, *args):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class NullPool:
+    def acquire(self):
+        return NullConnection()
+
+
+async def main(args):
+    generated = await generate_module(args, DDL)
+    table = generated.bench_update
+    obj = await table.create_many([{}], returning=True)
+    obj = obj[0]
+    changes = [
+        {f'col_{i}': 'x', f'col_{(i * 7) % COLUMNS}': 'y'} for i in range(COLUMNS)
+    ]
+
+    db_pool = generated.pool
+    generated.pool = NullPool()
+    with timed('update() statement building only', args.rows):
+        for i in range(args.rows):
+            await obj.update(**changes[i % COLUMNS])
+
+    generated.pool = db_pool
+    with timed('update() against the database', args.rows):
+        for i in range(args.rows):
+            await obj.update(**changes[i % COLUMNS])
+
+    await db_pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(make_parser(__doc__).parse_args()))
@@ -0,0 +1,67 @@
+""" Shared setup for the benchmarks.
+
+Each benchmark creates a scratch table, runs the generator against it,
+imports the generated module and points its ``pool`` at the database.
+
+Run from the repo root, e.g.::
+
+    PYTHONPATH=. python benchmarks/bench_create_many.py --db crudtest
+
+"""
+import importlib.util
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+from types import SimpleNamespace
+
+import asyncpg
+
+import pg_crud_gen
+
+
+def make_parser(description: str) -> ArgumentParser:
+    parser = ArgumentParser(description=description)
+    parser.add_argument('--db', type=str, default='postgres')
+    parser.add_argument('--user', type=str, default='postgres')
+    parser.add_argument('--password', type=str, default='postgres')
+    parser.add_argument('--host', type=str, default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--rows', type=int, default=10000)
+    return parser
+
+
+def dsn(args) -> str:
+    return f'postgresql://{args.user}:{args.password}@{args.host}:{args.port}/{args.db}'
+
+
+async def generate_module(args, ddl: str, name='bench_generated'):
+    """ Execute `ddl`, generate the CRUD module for the schema and
+    return it imported, with a connected pool. """
+    conn = await asyncpg.connect(dsn(args))
+    try:
+        await conn.execute(ddl)
+    finally:
+        await conn.close()
+
+    outfile = Path(tempfile.mkdtemp()) / f'{name}.py'
+    gen_args = SimpleNamespace(
+        outfile=str(outfile), db=args.db, schema='public', user=args.user,
+        password=args.password, host=args.host, port=args.port,
+    )
+    await pg_crud_gen.main(gen_args)
+
+    spec = importlib.util.spec_from_file_location(name, outfile)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.pool = await asyncpg.create_pool(dsn(args))
+    return module
+
+
+@contextmanager
+def timed(label: str, rows: int):
+    t0 = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - t0
+    print(f'{label:<40} {elapsed:8.3f}s {rows / elapsed:12,.0f} rows/s')
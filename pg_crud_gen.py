@@ -6,21 +6,29 @@ Code generator to make CRUD classes for an existing Postgres DB.
 
 """
 
+import os
 import sys
+import json
 import asyncio
+import hashlib
+import re
+from copy import copy
+from functools import lru_cache
+from fnmatch import fnmatchcase
+from concurrent.futures import ProcessPoolExecutor
 from collections import OrderedDict, defaultdict
-from typing import NamedTuple, List, Dict, Iterable
+from typing import NamedTuple, List, Dict, Iterable, Sequence, Tuple
 from textwrap import indent
 import logging
 
 from asyncpg.connection import Connection
+from asyncpg.pool import Pool
 from argparse import (
     RawDescriptionHelpFormatter,
     ArgumentDefaultsHelpFormatter,
     ArgumentParser
 )
 from string import Template
-from pprint import pprint
 
 import asyncpg
 import ipaddress
@@ -41,10 +49,19 @@ header = '''\
 
 """
 import uuid
+import asyncio
 import datetime
 import ipaddress
 import json
-from typing import List, Sequence
+import time
+import bisect
+import random
+import itertools
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from decimal import Decimal
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, NamedTuple, Sequence, Iterable, Mapping
 from enum import Enum
 import asyncpg
 from asyncpg.pool import Pool
@@ -53,15 +70,555 @@ from autoslot import Slots
 
 pool: Pool = None
 
+# Number of rows sent per round trip by the bulk methods.
+BULK_CHUNK_SIZE = 5000
+
+
+def _chunks(iterable, size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Reads waiting for the next batch, per class, while read batching is on.
+_pending_reads = {{}}
+_background_tasks = set()
+
+
+# The connection of the enclosing session(), if any.
+_session_connection: ContextVar = ContextVar('session_connection', default=None)
+
+
+@asynccontextmanager
+async def session(conn: asyncpg.Connection = None, transaction=True):
+    """ Make every generated method called inside the block use one
+    connection, by default inside one transaction, instead of taking a
+    connection from the pool per call:
+
+        async with generated.session():
+            obj = await thing.create(...)
+            await obj.update(...)
+
+    Pass `conn` to use a connection you already hold. Nested sessions
+    reuse the outer connection (and a savepoint). Don't run generated
+    methods concurrently in tasks started inside a session: they would
+    share its connection. """
+    outer = _session_connection.get()
+    if conn is None and outer is not None:
+        conn = outer
+    if conn is None:
+        async with pool.acquire() as conn:
+            async with session(conn, transaction):
+                yield conn
+        return
+
+    token = _session_connection.set(conn)
+    try:
+        if transaction:
+            async with conn.transaction():
+                yield conn
+        else:
+            yield conn
+    finally:
+        _session_connection.reset(token)
+
+
+# Instrumentation hooks, called with a QueryEvent before and after each
+# statement run by a generated method. See add_hooks().
+_before_hooks = []
+_after_hooks = []
+
+
+def add_hooks(before=None, after=None):
+    """ Register instrumentation hooks. Each is called with a QueryEvent
+    for every statement the generated methods run: `before` just before
+    it is sent, `after` once it completed or failed. Hooks run inline,
+    so they should be quick. While no hook is registered, connections
+    are used as they are, with no timing or wrapping. """
+    if before is not None:
+        _before_hooks.append(before)
+    if after is not None:
+        _after_hooks.append(after)
+
+
+def remove_hooks(before=None, after=None):
+    if before is not None:
+        _before_hooks.remove(before)
+    if after is not None:
+        _after_hooks.remove(after)
+
+
+class QueryEvent:
+    """ One statement run by a generated method, as given to the hooks.
+    `table` and `op` (the method) name the caller. `wait` is the time
+    spent in ``pool.acquire()``, counted on the first statement of the
+    method. `rows`, `elapsed` (seconds) and `error` are set for the
+    after hooks. `params` are the bound parameters. `copy` is set for
+    COPY, where `sql` is the query or table being copied. """
+    __slots__ = ('table', 'op', 'sql', 'params', 'wait', 'copy', 'rows', 'elapsed', 'error')
+
+    def __init__(self, table: str, op: str, sql: str, params: tuple, wait: float, copy=False):
+        self.table = table
+        self.op = op
+        self.sql = sql
+        self.params = params
+        self.wait = wait
+        self.copy = copy
+        self.rows = None
+        self.elapsed = None
+        self.error = None
+
+    def __repr__(self):
+        fields = ', '.join(f'{{k}}={{getattr(self, k)!r}}' for k in self.__slots__)
+        return f'QueryEvent({{fields}})'
+
+
+def _status_rows(status: str):
+    """ The row count in a command status such as 'UPDATE 3'. """
+    last = status.rsplit(' ', 1)[-1]
+    return int(last) if last.isdigit() else None
+
+
+class _InstrumentedConnection:
+    """ A connection that reports each statement to the hooks. Anything
+    not reported, such as transaction() or cursor(), is passed through. """
+    __slots__ = ('_conn', '_table', '_op', '_wait')
+
+    def __init__(self, conn: asyncpg.Connection, table: str, op: str, wait: float):
+        self._conn = conn
+        self._table = table
+        self._op = op
+        self._wait = wait
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _run(self, count, method, sql: str, *args, copy=False, **kwargs):
+        params = args[1:] if args and args[0] is sql else ()
+        event = QueryEvent(self._table, self._op, sql, params, self._wait, copy)
+        self._wait = 0.0
+        for hook in _before_hooks:
+            hook(event)
+        start = time.perf_counter()
+        try:
+            result = await method(*args, **kwargs)
+            event.rows = count(result)
+            return result
+        except Exception as e:
+            event.error = e
+            raise
+        finally:
+            event.elapsed = time.perf_counter() - start
+            for hook in _after_hooks:
+                hook(event)
+
+    def fetch(self, query, *args, **kwargs):
+        return self._run(len, self._conn.fetch, query, query, *args, **kwargs)
+
+    def fetchrow(self, query, *args, **kwargs):
+        return self._run(
+            lambda r: int(r is not None), self._conn.fetchrow, query, query, *args, **kwargs
+        )
+
+    def fetchval(self, query, *args, **kwargs):
+        return self._run(
+            lambda r: int(r is not None), self._conn.fetchval, query, query, *args, **kwargs
+        )
+
+    def execute(self, query, *args, **kwargs):
+        return self._run(_status_rows, self._conn.execute, query, query, *args, **kwargs)
+
+    def copy_from_query(self, query, *args, **kwargs):
+        return self._run(
+            _status_rows, self._conn.copy_from_query, query, query, *args, copy=True, **kwargs
+        )
+
+    def copy_from_table(self, table_name, **kwargs):
+        return self._run(
+            _status_rows, self._conn.copy_from_table,
+            f'COPY {{_copy_target(table_name, kwargs)}} TO STDOUT',
+            table_name, copy=True, **kwargs
+        )
+
+    def copy_records_to_table(self, table_name, **kwargs):
+        return self._run(
+            _status_rows, self._conn.copy_records_to_table,
+            f'COPY {{_copy_target(table_name, kwargs)}} FROM STDIN',
+            table_name, copy=True, **kwargs
+        )
+
+
+def _copy_target(table_name: str, kwargs: dict) -> str:
+    schema = kwargs.get('schema_name')
+    return f'{{schema}}.{{table_name}}' if schema else table_name
+
+
+class LatencyHistogram:
+    """ An after hook that keeps, per (table, op), the statement count,
+    acquire waits and a histogram of execution times in buckets that
+    double from 0.1 ms up to about a minute::
+
+        histogram = LatencyHistogram()
+        add_hooks(after=histogram)
+        ...
+        histogram.summary()
+    """
+    bounds = tuple(0.0001 * 2 ** i for i in range(20))
+
+    def __init__(self):
+        # (table, op) -> [count, total time, max time, total wait, errors, buckets]
+        self._stats = {{}}
+
+    def __call__(self, event: QueryEvent):
+        stats = self._stats.get((event.table, event.op))
+        if stats is None:
+            stats = self._stats[event.table, event.op] = [
+                0, 0.0, 0.0, 0.0, 0, [0] * (len(self.bounds) + 1)
+            ]
+        stats[0] += 1
+        stats[1] += event.elapsed
+        stats[2] = max(stats[2], event.elapsed)
+        stats[3] += event.wait
+        stats[4] += event.error is not None
+        stats[5][bisect.bisect_left(self.bounds, event.elapsed)] += 1
+
+    def reset(self):
+        self._stats.clear()
+
+    def _percentile(self, buckets: list, count: int, maximum: float, q: float) -> float:
+        """ The upper bound of the bucket holding the `q` quantile. """
+        rank = q * count
+        seen = 0
+        for bound, n in zip(self.bounds, buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, maximum)
+        return maximum
+
+    def summary(self) -> dict:
+        """ Per (table, op): the number of statements and errors, the mean
+        and maximum execution time, the 50th, 95th and 99th percentiles
+        (to bucket resolution) and the mean acquire wait, in seconds. """
+        out = {{}}
+        for key, (count, total, maximum, wait, errors, buckets) in sorted(self._stats.items()):
+            out[key] = dict(
+                count=count,
+                errors=errors,
+                mean=total / count,
+                max=maximum,
+                p50=self._percentile(buckets, count, maximum, 0.50),
+                p95=self._percentile(buckets, count, maximum, 0.95),
+                p99=self._percentile(buckets, count, maximum, 0.99),
+                wait=wait / count,
+            )
+        return out
+
+
+class ExplainSlowQueries:
+    """ An after hook that captures the plan of statements slower than
+    `threshold` seconds. A sampled statement is explained again on a
+    separate pool connection, in the background: reads with
+    ``EXPLAIN (ANALYZE, BUFFERS)``, which runs them a second time, and
+    writes with plain ``EXPLAIN``. `callback` (a function or coroutine
+    function) is then called with the QueryEvent, which has the SQL and
+    bound parameters, and the plan as text::
+
+        add_hooks(after=ExplainSlowQueries(report, threshold=0.5, sample_rate=0.1))
+
+    To bound the overhead, a slow statement is explained with
+    probability `sample_rate`, at most once per `min_interval` seconds
+    and never while another explain is running. Since the plan comes
+    from another connection, it doesn't see uncommitted changes of the
+    original transaction. """
+
+    def __init__(self, callback, threshold: float = 1.0, sample_rate: float = 1.0,
+                 min_interval: float = 1.0):
+        self.callback = callback
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.min_interval = min_interval
+        self.last_error = None
+        self._last = float('-inf')
+        self._running = False
+
+    def __call__(self, event: QueryEvent):
+        if event.error is not None or event.elapsed < self.threshold or self._running:
+            return
+        if event.copy:
+            return
+        now = time.monotonic()
+        if now - self._last < self.min_interval or random.random() >= self.sample_rate:
+            return
+
+        self._last = now
+        self._running = True
+        task = asyncio.ensure_future(self._explain(event))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    async def _explain(self, event: QueryEvent):
+        try:
+            read = event.sql.lstrip()[:6].upper() == 'SELECT'
+            options = '(ANALYZE, BUFFERS) ' if read else ''
+            async with pool.acquire() as conn:
+                records = await conn.fetch(f'EXPLAIN {{options}}{{event.sql}}', *event.params)
+            result = self.callback(event, '\\n'.join(r[0] for r in records))
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            self.last_error = e
+        finally:
+            self._running = False
+
+
+class _acquire:
+    """ Like ``pool.acquire()``, but yields the session connection if
+    there is one. While instrumentation hooks are registered, the
+    connection reports its statements on behalf of `table` and `op`. """
+    __slots__ = ('_ctx', '_table', '_op')
+
+    def __init__(self, table: str = None, op: str = None):
+        self._table = table
+        self._op = op
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        conn = _session_connection.get()
+        wait = 0.0
+        if conn is not None:
+            self._ctx = None
+        else:
+            self._ctx = pool.acquire()
+            if not (_before_hooks or _after_hooks):
+                return await self._ctx.__aenter__()
+            start = time.perf_counter()
+            conn = await self._ctx.__aenter__()
+            wait = time.perf_counter() - start
+
+        if not (_before_hooks or _after_hooks):
+            return conn
+        return _InstrumentedConnection(conn, self._table, self._op, wait)
+
+    async def __aexit__(self, *exc):
+        if self._ctx is not None:
+            await self._ctx.__aexit__(*exc)
+
+
+def _where(where_clause: str) -> str:
+    return f'\\nWHERE {{where_clause}}' if where_clause else ''
+
+
+def _is_array_type(pgtype: str) -> bool:
+    """ Whether `pgtype`, as in `_pgtypes`, is an array type. Those are
+    named after their element type with a leading underscore; types
+    outside pg_catalog are given as quoted, schema-qualified names. """
+    return pgtype.startswith('_') or '."_' in pgtype
+
+
+# The functions aggregate() accepts.
+_AGGREGATES = {{'count', 'sum', 'min', 'max', 'avg'}}
+
 
 class UNCHANGED:
     pass
 
 
+class ReadCache:
+    """ Bounded LRU cache with a time-to-live, keyed by primary key.
+    Assign one to a generated class's `cache` attribute to make read()
+    read-through. The counters are there to help size it. """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # pk -> (expiry, instance)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, pk):
+        entry = self._entries.get(pk)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expiry, obj = entry
+        if expiry < time.monotonic():
+            del self._entries[pk]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(pk)
+        self.hits += 1
+        return obj
+
+    def put(self, pk, obj):
+        self._entries[pk] = (time.monotonic() + self.ttl, obj)
+        self._entries.move_to_end(pk)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, pk):
+        self._entries.pop(pk, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return dict(
+            size=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+
+class RowView:
+    """ Read-only view of a row that reads attributes straight from the
+    underlying asyncpg Record, without copying anything into a table
+    instance. `load()` returns the full instance; `update()`, `delete()`
+    and `delete_hard()` load it first and return it. """
+    __slots__ = ('_record',)
+    _table_class = None
+
+    def __init__(self, record):
+        self._record = record
+
+    def __repr__(self):
+        fields = ', '.join(f'{{k}}={{v!r}}' for k, v in self._record.items())
+        return f'{{self._table_class.__name__}}View({{fields}})'
+
+    def json(self, pretty=None) -> str:
+        return json.dumps(dict(self._record.items()), default=str, indent=pretty and 4)
+
+    def load(self) -> 'CRUDTable':
+        cls = self._table_class
+        if tuple(self._record.keys()) == cls._columns:
+            return cls._from_record(self._record)
+        return cls._from_partial(self._record)
+
+    async def update(self, **kwargs) -> 'CRUDTable':
+        obj = self.load()
+        await obj.update(**kwargs)
+        return obj
+
+    async def delete(self) -> 'CRUDTable':
+        obj = self.load()
+        await obj.delete()
+        return obj
+
+    async def delete_hard(self) -> 'CRUDTable':
+        obj = self.load()
+        await obj.delete_hard()
+        return obj
+
+
+def _view_property(name: str) -> property:
+    def get(self):
+        try:
+            return self._record[name]
+        except KeyError:
+            raise AttributeError(
+                f'{{self._table_class.__name__}}.{{name}} was not loaded. '
+                f'Include it in `columns=` when reading.'
+            ) from None
+    return property(get)
+
+
+class Page(NamedTuple):
+    items: list
+    # Pass back as `after=` to get the next page. None on the last page.
+    after: tuple
+
+
+# Generated classes by table name, for following relations.
+_tables = {{}}
+
+
+async def prefetch(objects: Sequence['CRUDTable'], *relations: str):
+    """ Load the named relations of `objects`, which are instances of one
+    table, with one query per relation, and attach them so that the
+    relation accessors don't query again. A many-to-one relation gives an
+    instance or None, a one-to-many relation a list. """
+    objects = list(objects)
+    if not objects:
+        return
+    cls = type(objects[0])
+    for name in relations:
+        await cls._prefetch(objects, name)
+
+
 class CRUDTable(Slots):
+    # When True, concurrent read() calls made in the same event loop
+    # iteration are merged into a single read_by_pks() query.
+    batch_reads = False
+    # An optional ReadCache for read(). update() and delete() refresh
+    # their entry, delete_hard() drops it and update_many() clears it.
+    # Inside a session(), whose writes may still be rolled back, read()
+    # bypasses the cache and writes only drop entries.
+    cache: ReadCache = None
+    # Column name -> bit, in the same order as the update() bitmask.
+    _update_bits = {{}}
+    # Relation name -> (one-to-many?, column here, other table, column there).
+    _relations = {{}}
+    # Column here -> the names of the relations that follow it.
+    _relation_columns = {{}}
+
+    def __init__(self):
+        # Bitmask of the columns assigned since the instance was read or
+        # last written. Instances built with __init__ start all dirty.
+        self._dirty = 0
+        # Relation name -> the rows loaded for it by prefetch(). Left
+        # unset on instances read from the database until then.
+        self._related = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if '_tracking_of' not in cls.__dict__:
+            _tables[cls._table] = cls
+            cls._relation_columns = {{}}
+            for name, (_, column, _, _) in cls._relations.items():
+                cls._relation_columns.setdefault(column, []).append(name)
+            # A twin class with plain attribute assignment. Instances are
+            # filled in as this class and then switched over, so loading
+            # rows doesn't pay for the change tracking in __setattr__.
+            cls._untracked = type(cls.__name__, (cls,), dict(
+                __slots__=(), __setattr__=object.__setattr__, _tracking_of=cls
+            ))
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        bit = self._update_bits.get(name)
+        if bit:
+            object.__setattr__(self, '_dirty', self._dirty | bit)
+        relations = self._relation_columns.get(name)
+        if relations:
+            # Rows loaded for the old value of the column no longer apply.
+            related = getattr(self, '_related', None)
+            if related:
+                for relation in relations:
+                    related.pop(relation, None)
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set, such as columns
+        # left out of a read with `columns=`.
+        cls = type(self)
+        if name in getattr(cls, '_columns', ()):
+            raise AttributeError(
+                f'{{cls.__name__}}.{{name}} was not loaded. Include it in '
+                f'`columns=` when reading, or read the full row.'
+            )
+        raise AttributeError(f"'{{cls.__name__}}' object has no attribute '{{name}}'")
+
     def __repr__(self):
         """ Try hard to use the repr of the attributes too. """
-        d = {{k: getattr(self, k) for k in self.__slots__}}
+        d = {{k: getattr(self, k) for k in self.__slots__ if hasattr(self, k)}}
         fields = ', '.join(f'{{k}}={{v!r}}' for k, v in d.items())
         return f'{{self.__class__.__name__}}({{fields}})'
 
@@ -69,9 +626,787 @@ class CRUDTable(Slots):
         return repr(self)
 
     def json(self, pretty=None) -> str:
-        d = {{k: getattr(self, k) for k in self.__slots__}}
+        d = {{k: getattr(self, k) for k in self.__slots__ if hasattr(self, k)}}
         return json.dumps(d, default=str, indent=pretty and 4)
 
+    @classmethod
+    async def create_many(cls, rows: Iterable[Mapping], *, returning=False, chunk_size: int = None):
+        """ Insert many rows in one transaction, `chunk_size` rows per
+        round trip. Each row is a mapping of column name to value, and
+        missing columns are inserted as NULL. A key that isn't one of
+        `_insert_fields` raises ValueError, and nothing is inserted.
+
+        With `returning=False` the rows are loaded with COPY and the
+        number of inserted rows is returned. With `returning=True` each
+        chunk is a single ``INSERT ... SELECT`` (see `_bulk_rows`) and the
+        created instances are returned. """
+        fields = cls._insert_fields
+        allowed = set(fields)
+        chunk_size = cls._bulk_chunk_size(fields, chunk_size)
+        created = []
+        count = 0
+        async with _acquire(cls._table, 'create_many') as conn:
+            async with conn.transaction():
+                for chunk in _chunks(rows, chunk_size):
+                    for row in chunk:
+                        if not allowed.issuperset(row):
+                            raise ValueError(
+                                f'Cannot insert columns of {{cls._table}}: '
+                                f'{{sorted(set(row) - allowed)}}'
+                            )
+                    records = [tuple(row.get(f) for f in fields) for row in chunk]
+                    if returning:
+                        source, args = cls._bulk_rows(fields, records)
+                        sql = (
+                            f'INSERT INTO {{cls._qualified_table}} ({{", ".join(fields)}})\\n'
+                            f'SELECT * FROM {{source}} AS v\\n'
+                            f'RETURNING *'
+                        )
+                        created.extend(cls._from_record(r) for r in await conn.fetch(sql, *args))
+                    else:
+                        await conn.copy_records_to_table(
+                            cls._table, schema_name=cls._schema, records=records, columns=fields
+                        )
+                    count += len(records)
+
+        return created if returning else count
+
+    @classmethod
+    async def iter_many(cls, where_clause: str = '', params: Sequence = (), prefetch: int = 1000,
+                        columns: Sequence[str] = None, as_view=False):
+        """ Like `read_many`, but yields rows as they arrive from a
+        server-side cursor, fetching `prefetch` rows per round trip.
+        Only one batch is held in memory at a time. Stopping early (and
+        closing the generator) ends the transaction without fetching the
+        remaining rows. """
+        async with _acquire(cls._table, 'iter_many') as conn:
+            async with conn.transaction():
+                cursor = conn.cursor(
+                    f'SELECT {{cls._select_list(columns)}} FROM {{cls._qualified_table}}{{_where(where_clause)}}',
+                    *params, prefetch=prefetch
+                )
+                make = cls._row_factory(columns, as_view)
+                async for r in cursor:
+                    yield make(r)
+
+    @classmethod
+    def _row_factory(cls, columns: Sequence[str] = None, as_view=False):
+        """ What turns a fetched record into a result row. """
+        if as_view:
+            return cls._view_class()
+        if columns is not None:
+            return cls._from_partial
+        return cls._from_record
+
+    @classmethod
+    def _view_class(cls) -> type:
+        """ The RowView subclass for this table, made on first use. """
+        view = cls.__dict__.get('_view')
+        if view is None:
+            namespace = {{name: _view_property(name) for name in cls._columns}}
+            namespace.update(__slots__=(), _table_class=cls)
+            view = type(f'{{cls.__name__}}View', (RowView,), namespace)
+            cls._view = view
+        return view
+
+    @classmethod
+    def _select_list(cls, columns: Sequence[str] = None) -> str:
+        """ The SELECT list for a projection: `columns` plus the primary
+        key, or * for all columns. """
+        if columns is None:
+            return '*'
+
+        if isinstance(columns, str):
+            columns = (columns,)
+        unknown = set(columns) - set(cls._columns)
+        if unknown:
+            raise ValueError(f'Unknown columns for {{cls._table}}: {{sorted(unknown)}}')
+        return ', '.join(dict.fromkeys((cls._pk, *columns)))
+
+    @classmethod
+    def _from_partial(cls, record):
+        """ An instance with only the columns in `record` set. """
+        obj = object.__new__(cls._untracked)
+        for k, v in record.items():
+            setattr(obj, k, v)
+        obj._dirty = 0
+        obj.__class__ = cls
+        return obj
+
+    def _recache(self):
+        """ Refresh the cache entry for this instance after a write. An
+        instance with columns left unset (read with `columns=`) only
+        drops the entry, so that read() never returns a partial row, and
+        so does a write inside a session, which isn't committed yet. """
+        pk = getattr(self, self._pk)
+        complete = all(hasattr(self, c) for c in self._columns)
+        if complete and _session_connection.get() is None:
+            self.cache.put(pk, self)
+        else:
+            self.cache.invalidate(pk)
+
+    def changes(self) -> dict:
+        """ The columns assigned since the instance was read or last
+        written, with their current values. """
+        _, fields = self._set_clause(self._dirty, 2)
+        return {{f: getattr(self, f) for f in fields}}
+
+    async def save(self) -> bool:
+        """ Write only the columns assigned since the instance was read
+        or last written. Nothing is sent when there are none. Returns
+        whether anything was written. """
+        if not self._dirty:
+            return False
+
+        await self.update(**self.changes())
+        return True
+
+    @classmethod
+    async def count(cls, where_clause: str = '', params: Sequence = ()) -> int:
+        """ The number of rows matching `where_clause`, counted by the
+        server. """
+        async with _acquire(cls._table, 'count') as conn:
+            return await conn.fetchval(
+                f'SELECT count(*) FROM {{cls._qualified_table}}{{_where(where_clause)}}', *params
+            )
+
+    @classmethod
+    async def exists(cls, where_clause: str = '', params: Sequence = ()) -> bool:
+        """ Whether any row matches `where_clause`. The server stops at the
+        first one. """
+        async with _acquire(cls._table, 'exists') as conn:
+            return await conn.fetchval(
+                f'SELECT EXISTS (SELECT 1 FROM {{cls._qualified_table}}{{_where(where_clause)}})',
+                *params
+            )
+
+    @classmethod
+    async def aggregate(cls, metrics: Mapping[str, Any], group_by: Sequence[str] = (),
+                        where_clause: str = '', params: Sequence = ()):
+        """ Compute `metrics` on the server, over the rows matching
+        `where_clause`. Each metric maps a result name to 'count' or to a
+        (function, column) pair, where the function is one of count, sum,
+        min, max or avg, e.g. ``{{'n': 'count', 'total': ('sum', 'amount')}}``.
+
+        Without `group_by` one record of the metrics is returned. With it,
+        a record per group of the `group_by` columns followed by the
+        metrics, ordered by the group columns. """
+        if isinstance(group_by, str):
+            group_by = (group_by,)
+        unknown = set(group_by) - set(cls._columns)
+        if unknown:
+            raise ValueError(f'Unknown columns for {{cls._table}}: {{sorted(unknown)}}')
+
+        select = list(group_by)
+        for name, metric in metrics.items():
+            func, column = ('count', '*') if metric == 'count' else metric
+            if not name.isidentifier():
+                raise ValueError(f'Invalid metric name {{name!r}}')
+            if func not in _AGGREGATES:
+                raise ValueError(f'Unknown aggregate {{func!r}}, use one of {{sorted(_AGGREGATES)}}')
+            if column not in cls._columns and (column, func) != ('*', 'count'):
+                raise ValueError(f'Unknown column for {{cls._table}}: {{column!r}}')
+            select.append(f'{{func}}({{column}}) AS {{name}}')
+
+        sql = f'SELECT {{", ".join(select)}} FROM {{cls._qualified_table}}{{_where(where_clause)}}'
+        async with _acquire(cls._table, 'aggregate') as conn:
+            if not group_by:
+                return await conn.fetchrow(sql, *params)
+            columns = ', '.join(group_by)
+            return await conn.fetch(f'{{sql}}\\nGROUP BY {{columns}}\\nORDER BY {{columns}}', *params)
+
+    @classmethod
+    async def estimate_count(cls) -> int:
+        """ The planner's estimate of the number of rows, from
+        pg_class.reltuples. It costs the same for any table size, but is
+        only as fresh as the last VACUUM or ANALYZE. A partitioned table
+        has no estimate of its own, so its partitions' estimates (and
+        those of any child tables) are summed. For a table that has never
+        been analyzed, or looks empty, this falls back to count(). """
+        async with _acquire(cls._table, 'estimate_count') as conn:
+            estimate = await conn.fetchval("""\\
+                WITH RECURSIVE tables(oid) AS (
+                    SELECT $1::regclass::oid
+                  UNION ALL
+                    SELECT i.inhrelid FROM pg_inherits i JOIN tables t ON i.inhparent = t.oid
+                )
+                SELECT sum(greatest(c.reltuples, 0))::bigint
+                FROM pg_class c JOIN tables t ON c.oid = t.oid
+                WHERE c.relkind <> 'p'
+            """, cls._qualified_table)
+        # reltuples is -1 for a table never analyzed on PostgreSQL 14+, but
+        # 0 on older servers, where that can't be told apart from empty.
+        if not estimate:
+            return await cls.count()
+        return estimate
+
+    @classmethod
+    async def export(cls, where_clause: str = '', params: Sequence = (), *, output,
+                     fmt='csv', columns: Sequence[str] = None) -> int:
+        """ Stream the rows matching `where_clause` to `output` with COPY,
+        without building rows in Python, so memory use doesn't depend on
+        the number of rows. `output` is a path, a file-like object with an
+        async `write()`, or a coroutine function called with each chunk of
+        bytes. `fmt` is 'csv' (with a header line), 'binary' (COPY's
+        binary format) or 'jsonl' (one JSON object per row). Only
+        `columns`, in that order, are exported if given. Returns the
+        number of rows exported. """
+        if fmt not in ('csv', 'binary', 'jsonl'):
+            raise ValueError(f"Unknown format {{fmt!r}}, use 'csv', 'binary' or 'jsonl'")
+        if isinstance(columns, str):
+            columns = (columns,)
+        if columns is not None:
+            unknown = set(columns) - set(cls._columns)
+            if unknown:
+                raise ValueError(f'Unknown columns for {{cls._table}}: {{sorted(unknown)}}')
+
+        options = dict(output=output, format=fmt)
+        if fmt == 'csv':
+            options.update(header=True)
+        elif fmt == 'jsonl':
+            # row_to_json() escapes control characters, so with these as
+            # quote and delimiter csv never quotes and the lines are the
+            # JSON text as is.
+            options.update(format='csv', quote='\\x01', delimiter='\\x02')
+
+        async with _acquire(cls._table, 'export') as conn:
+            if not where_clause and fmt != 'jsonl':
+                status = await conn.copy_from_table(
+                    cls._table, schema_name=cls._schema, columns=columns, **options
+                )
+            else:
+                select = '*' if columns is None else ', '.join(columns)
+                sql = f'SELECT {{select}} FROM {{cls._qualified_table}}{{_where(where_clause)}}'
+                if fmt == 'jsonl':
+                    sql = f'SELECT row_to_json(t) FROM ({{sql}}) t'
+                status = await conn.copy_from_query(sql, *params, **options)
+        return int(status.split()[-1])
+
+    @classmethod
+    async def read_columns(cls, where_clause: str = '', params: Sequence = (),
+                           columns: Sequence[str] = None, numpy=False) -> Dict[str, Any]:
+        """ The rows matching `where_clause` as one list per column, in
+        the same row order, keyed by column name. Each column arrives as a
+        single array from the server, so no per-row objects are built.
+        Arrays keep their element types, but multidimensional arrays come
+        back flattened.
+
+        With `numpy`, columns of a type in `_numpy_dtypes` become arrays
+        of that dtype, and the rest object arrays. Integer columns with
+        NULLs become float64 with NaN, timestamps with time zone are
+        given in UTC, and NULL times are NaT. """
+        if columns is None:
+            columns = cls._columns
+        elif isinstance(columns, str):
+            columns = (columns,)
+        unknown = set(columns) - set(cls._columns)
+        if unknown:
+            raise ValueError(f'Unknown columns for {{cls._table}}: {{sorted(unknown)}}')
+
+        arrays = [c for c in columns if _is_array_type(cls._pgtypes[c])]
+        # With array columns the rows are numbered first, to keep every
+        # column in the same order.
+        order = ' ORDER BY _row' if arrays else ''
+        select = []
+        for c in columns:
+            if c in arrays:
+                # array_agg() can't collect arrays of differing lengths, so
+                # an array column is sent as the length of each array and
+                # all of their elements in one flat array instead.
+                select.append(f'array_agg(cardinality({{c}}){{order}}) AS {{c}}')
+                select.append(
+                    f'(SELECT array_agg(_elem ORDER BY _row, _ord) FROM _rows, '
+                    f'unnest({{c}}) WITH ORDINALITY AS _u(_elem, _ord)) AS {{c}}__elements'
+                )
+            elif numpy and cls._pgtypes[c] == 'timestamptz':
+                select.append(f"array_agg({{c}} AT TIME ZONE 'UTC'{{order}}) AS {{c}}")
+            else:
+                select.append(f'array_agg({{c}}{{order}}) AS {{c}}')
+
+        if arrays:
+            sql = (
+                f'WITH _rows AS (\\n'
+                f'SELECT row_number() OVER () AS _row, {{", ".join(columns)}}\\n'
+                f'FROM {{cls._qualified_table}}{{_where(where_clause)}}\\n'
+                f')\\n'
+                f'SELECT {{", ".join(select)}} FROM _rows'
+            )
+        else:
+            sql = f'SELECT {{", ".join(select)}} FROM {{cls._qualified_table}}{{_where(where_clause)}}'
+        async with _acquire(cls._table, 'read_columns') as conn:
+            record = await conn.fetchrow(sql, *params)
+
+        result = {{}}
+        for c in columns:
+            values = record[c] or []
+            if c in arrays:
+                elements = iter(record[f'{{c}}__elements'] or ())
+                values = [
+                    None if n is None else list(itertools.islice(elements, n))
+                    for n in values
+                ]
+            result[c] = values
+
+        if numpy:
+            import numpy as np
+
+            for c, values in result.items():
+                dtype = cls._numpy_dtypes.get(c, object)
+                if dtype in ('int64', 'bool') and None in values:
+                    dtype = 'float64' if dtype == 'int64' else object
+                result[c] = np.array(values, dtype=dtype)
+        return result
+
+    @classmethod
+    async def page(cls, after=None, limit: int = 100, order_by: Sequence[str] = (),
+                   where_clause: str = '', params: Sequence = (), descending=False) -> Page:
+        """ Keyset pagination. Rows are ordered by the `order_by` columns,
+        with the primary key appended as a tie-breaker, and each page
+        starts directly after the `after` key instead of skipping rows
+        with OFFSET. With an index on the ordering columns, deep pages
+        cost the same as the first one.
+
+        `after` is the `Page.after` token of the previous page (or, when
+        ordering by the primary key alone, a primary key value). The
+        ordering columns should be NOT NULL. Parameters in the
+        `where_clause` start numbering at $1. """
+        if isinstance(order_by, str):
+            order_by = (order_by,)
+        keys = tuple(order_by)
+        if cls._pk not in keys:
+            keys += (cls._pk,)
+        unknown = set(keys) - set(cls._columns)
+        if unknown:
+            raise ValueError(f'Unknown columns for {{cls._table}}: {{sorted(unknown)}}')
+
+        conditions = [f'({{where_clause}})'] if where_clause else []
+        args = list(params)
+        if after is not None:
+            if not isinstance(after, tuple):
+                after = (after,)
+            if len(after) != len(keys):
+                raise ValueError(f'`after` must have a value for each of {{keys}}')
+            op = '<' if descending else '>'
+            placeholders = ', '.join(f'${{len(args) + i + 1}}' for i in range(len(keys)))
+            conditions.append(f'({{", ".join(keys)}}) {{op}} ({{placeholders}})')
+            args.extend(after)
+
+        direction = ' DESC' if descending else ''
+        order = ', '.join(k + direction for k in keys)
+        async with _acquire(cls._table, 'page') as conn:
+            records = await conn.fetch(
+                f'SELECT * FROM {{cls._qualified_table}}{{_where(" AND ".join(conditions))}}\\n'
+                f'ORDER BY {{order}}\\n'
+                f'LIMIT {{int(limit)}}',
+                *args
+            )
+
+        token = None
+        if records and len(records) == limit:
+            token = tuple(records[-1][k] for k in keys)
+        return Page([cls._from_record(r) for r in records], token)
+
+    @classmethod
+    async def update_each(cls, items: Iterable, fields: Sequence[str] = None, *, chunk_size: int = None) -> int:
+        """ Write different values to many rows in one statement per
+        chunk, all in one transaction. `items` are instances or mappings
+        that include the primary key. `fields` are the columns to set;
+        it defaults to every updatable column for instances, and to the
+        keys of the first mapping otherwise. Returns the number of rows
+        updated. """
+        items = iter(items)
+        first = next(items, None)
+        if first is None:
+            return 0
+
+        items = itertools.chain([first], items)
+        is_mapping = isinstance(first, Mapping)
+        if fields is None:
+            fields = [f for f in first if f != cls._pk] if is_mapping else cls._update_fields
+        fields = tuple(fields)
+        unknown = set(fields) - set(cls._update_fields)
+        if unknown:
+            raise ValueError(f'Cannot update columns of {{cls._table}}: {{sorted(unknown)}}')
+
+        names = (cls._pk,) + fields
+        get = (lambda item, f: item[f]) if is_mapping else getattr
+        count = 0
+        async with _acquire(cls._table, 'update_each') as conn:
+            async with conn.transaction():
+                for chunk in _chunks(items, cls._bulk_chunk_size(names, chunk_size)):
+                    rows = [tuple(get(item, f) for f in names) for item in chunk]
+                    source, args = cls._bulk_rows(names, rows)
+                    sql = (
+                        f'UPDATE {{cls._qualified_table}}\\n'
+                        f'SET {{", ".join(f"{{f}} = v.{{f}}" for f in fields)}}\\n'
+                        f'FROM {{source}} AS v({{", ".join(names)}})\\n'
+                        f'WHERE {{cls._qualified_table}}.{{cls._pk}} = v.{{cls._pk}}'
+                    )
+                    status = await conn.execute(sql, *args)
+                    count += int(status.split()[-1])
+                    if cls.cache is not None:
+                        for row in rows:
+                            cls.cache.invalidate(row[0])
+
+        return count
+
+    @classmethod
+    async def upsert_many(cls, rows: Iterable[Mapping], *, conflict_on: Sequence[str] = None,
+                          returning=False, chunk_size: int = None):
+        """ Insert many rows, updating those that conflict on a unique
+        key, with one ``INSERT ... SELECT ... ON CONFLICT`` (see
+        `_bulk_rows`) per chunk, all in one transaction. The columns are the keys of
+        the first row. `conflict_on` defaults to the first unique key
+        (see `_unique_keys`) covered by those columns. A key may appear
+        only once per chunk. Returns the rows if `returning`, otherwise
+        the number of rows inserted or updated. """
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return [] if returning else 0
+
+        fields = tuple(first)
+        conflict = cls._upsert_conflict(fields, conflict_on, returning)
+        head = f'INSERT INTO {{cls._qualified_table}} ({{", ".join(fields)}})\\n'
+        result = []
+        count = 0
+        async with _acquire(cls._table, 'upsert_many') as conn:
+            async with conn.transaction():
+                chunks = _chunks(itertools.chain([first], rows), cls._bulk_chunk_size(fields, chunk_size))
+                for chunk in chunks:
+                    source, args = cls._bulk_rows(fields, [tuple(row[f] for f in fields) for row in chunk])
+                    sql = f'{{head}}SELECT * FROM {{source}} AS v\\n{{conflict}}'
+                    if returning:
+                        result.extend(cls._from_record(r) for r in await conn.fetch(sql, *args))
+                    else:
+                        status = await conn.execute(sql, *args)
+                        count += int(status.split()[-1])
+
+        if cls.cache is not None:
+            cls.cache.clear()
+        return result if returning else count
+
+    @classmethod
+    async def _upsert(cls, values: dict, conflict_on: Sequence[str] = None):
+        sql = cls._upsert_sql(tuple(values), conflict_on)
+        async with _acquire(cls._table, 'upsert') as conn:
+            r = await conn.fetchrow(sql, *values.values())
+        obj = cls._from_record(r)
+        if cls.cache is not None:
+            obj._recache()
+        return obj
+
+    @classmethod
+    def _upsert_sql(cls, fields: tuple, conflict_on: Sequence[str] = None) -> str:
+        key = ('upsert', fields, conflict_on and tuple(conflict_on))
+        sql = cls._sql_cache.get(key)
+        if sql is None:
+            sql = cls._sql_cache[key] = (
+                f'INSERT INTO {{cls._qualified_table}} ({{", ".join(fields)}})\\n'
+                f'VALUES ({{", ".join(f"${{i + 1}}" for i in range(len(fields)))}})\\n'
+                f'{{cls._upsert_conflict(fields, conflict_on)}}'
+            )
+        return sql
+
+    @classmethod
+    def _upsert_conflict(cls, fields: tuple, conflict_on: Sequence[str] = None, returning=True) -> str:
+        """ The ``ON CONFLICT`` clause for inserting `fields`. """
+        key = ('conflict', fields, conflict_on and tuple(conflict_on), returning)
+        sql = cls._sql_cache.get(key)
+        if sql is not None:
+            return sql
+
+        unknown = set(fields) - set(cls._columns)
+        if unknown:
+            raise ValueError(f'Unknown columns for {{cls._table}}: {{sorted(unknown)}}')
+
+        if conflict_on is not None:
+            target = tuple(conflict_on)
+            if not any(set(target) == set(k) for k in cls._unique_keys):
+                raise ValueError(f'{{target}} is not a unique key of {{cls._table}}')
+        else:
+            target = next((k for k in cls._unique_keys if set(k) <= set(fields)), None)
+            if target is None:
+                raise ValueError(
+                    f'The columns {{fields}} include none of the unique keys '
+                    f'of {{cls._table}}: {{cls._unique_keys}}'
+                )
+
+        # Updating the target columns to themselves is a no-op, but keeps
+        # RETURNING working when there is nothing else to update.
+        updates = [f for f in fields if f not in target] or target
+        sql = cls._sql_cache[key] = (
+            f'ON CONFLICT ({{", ".join(target)}}) DO UPDATE\\n'
+            f'SET {{", ".join(f"{{f}} = EXCLUDED.{{f}}" for f in updates)}}'
+            + ('\\nRETURNING *' if returning else '')
+        )
+        return sql
+
+    @classmethod
+    def _bulk_rows(cls, fields: tuple, rows: list) -> tuple:
+        """ A FROM item giving `rows`, tuples of values for `fields`, and
+        the arguments to send with it. Normally that is one array per
+        column, through unnest(). unnest() can't take array columns, which
+        it would see as 2-D arrays, so for those the rows are written out
+        as a VALUES list with one parameter per value instead. """
+        types = [cls._pgtypes[f] for f in fields]
+        if not cls._has_arrays(fields):
+            arrays = ', '.join(f'${{i + 1}}::{{t}}[]' for i, t in enumerate(types))
+            return f'unnest({{arrays}})', list(zip(*rows))
+
+        n = len(types)
+        values = ', '.join(
+            '(' + ', '.join(f'${{r * n + i + 1}}::{{t}}' for i, t in enumerate(types)) + ')'
+            for r in range(len(rows))
+        )
+        return f'(VALUES {{values}})', [v for row in rows for v in row]
+
+    @classmethod
+    def _bulk_chunk_size(cls, fields: tuple, chunk_size: int = None) -> int:
+        chunk_size = chunk_size or BULK_CHUNK_SIZE
+        if cls._has_arrays(fields):
+            # A VALUES list takes a parameter per value, and a statement
+            # can have at most 32767 of them.
+            chunk_size = min(chunk_size, 32767 // len(fields))
+        return chunk_size
+
+    @classmethod
+    def _has_arrays(cls, fields: tuple) -> bool:
+        return any(_is_array_type(cls._pgtypes[f]) for f in fields)
+
+    @classmethod
+    def _set_clause(cls, mask: int, offset: int) -> tuple:
+        """ The SET clause and column names for the update columns whose
+        bits are set in `mask`, with placeholders numbered from `offset`.
+        Built once per combination and kept on the class, so repeated
+        updates send identical SQL text and hit asyncpg's per-connection
+        prepared statement cache. """
+        key = ('set', mask, offset)
+        cached = cls._sql_cache.get(key)
+        if cached is None:
+            fields = tuple(f for i, f in enumerate(cls._update_fields) if mask >> i & 1)
+            clause = ', '.join(f'{{f}} = ${{offset + i}}' for i, f in enumerate(fields))
+            cached = cls._sql_cache[key] = clause, fields
+        return cached
+
+    @classmethod
+    def _update_sql(cls, mask: int) -> tuple:
+        """ The statement used by update() for the columns in `mask`. """
+        key = ('update', mask)
+        cached = cls._sql_cache.get(key)
+        if cached is None:
+            clause, fields = cls._set_clause(mask, 2)
+            sql = (
+                f'UPDATE {{cls._qualified_table}}\\nSET {{clause}}\\n'
+                f'WHERE {{cls._qualified_table}}.{{cls._pk}} = $1'
+            )
+            cached = cls._sql_cache[key] = sql, fields
+        return cached
+
+    @classmethod
+    async def delete_by_pks(cls, pks: Sequence, hard=False, deleted_at: datetime.datetime = None) -> int:
+        """ Soft delete (set `deleted_at`, by default to now) or, with
+        `hard`, delete the rows with the given primary keys in one
+        statement. Returns the number of rows affected. """
+        pks = list(pks)
+        if hard:
+            sql = f'DELETE FROM {{cls._qualified_table}}\\n'
+            args = (pks,)
+        else:
+            sql = f'UPDATE {{cls._qualified_table}}\\nSET deleted_at = $2\\n'
+            args = (pks, deleted_at or datetime.datetime.utcnow())
+        sql += f'WHERE {{cls._qualified_table}}.{{cls._pk}} = ANY($1::{{cls._pk_pgtype}}[])'
+        async with _acquire(cls._table, 'delete_by_pks') as conn:
+            status = await conn.execute(sql, *args)
+
+        if cls.cache is not None:
+            for pk in pks:
+                cls.cache.invalidate(pk)
+        return int(status.split()[-1])
+
+    @classmethod
+    async def read_by_pks(cls, pks: Sequence) -> list:
+        """ Read many rows by primary key in one query. The result is in
+        the same order as `pks`, with None for keys that don't exist. """
+        pks = list(pks)
+        async with _acquire(cls._table, 'read_by_pks') as conn:
+            records = await conn.fetch(
+                f'SELECT * FROM {{cls._qualified_table}}\\n'
+                f'WHERE {{cls._qualified_table}}.{{cls._pk}} = ANY($1::{{cls._pk_pgtype}}[])',
+                pks
+            )
+        found = {{r[cls._pk]: cls._from_record(r) for r in records}}
+        return [found.get(pk) for pk in pks]
+
+    @classmethod
+    async def _prefetch(cls, objects: list, name: str):
+        try:
+            many, column, table, remote = cls._relations[name]
+        except KeyError:
+            raise ValueError(
+                f'{{cls._table}} has no relation {{name!r}}, only {{sorted(cls._relations)}}'
+            ) from None
+
+        other = _tables[table]
+        keys = list({{getattr(obj, column) for obj in objects}} - {{None}})
+        records = []
+        if keys:
+            async with _acquire(table, 'prefetch') as conn:
+                records = await conn.fetch(
+                    f'SELECT * FROM {{other._qualified_table}}\\n'
+                    f'WHERE {{other._qualified_table}}.{{remote}} = ANY($1::{{other._pgtypes[remote]}}[])',
+                    keys
+                )
+
+        if many:
+            found = defaultdict(list)
+            for r in records:
+                found[r[remote]].append(other._from_record(r))
+        else:
+            found = {{r[remote]: other._from_record(r) for r in records}}
+
+        for obj in objects:
+            value = found.get(getattr(obj, column))
+            if many:
+                value = list(value or ())
+            related = getattr(obj, '_related', None)
+            if related is None:
+                related = {{}}
+                object.__setattr__(obj, '_related', related)
+            related[name] = value
+
+    async def _load_related(self, name: str):
+        """ The rows of a relation, as attached by prefetch() or else
+        loaded now. """
+        related = getattr(self, '_related', None)
+        if not related or name not in related:
+            await self._prefetch([self], name)
+        return self._related[name]
+
+    @classmethod
+    def _batched_read(cls, pk) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        pending = _pending_reads.get(cls)
+        if pending is None:
+            pending = _pending_reads[cls] = defaultdict(list)
+            loop.call_soon(cls._flush_reads)
+        fut = loop.create_future()
+        pending[pk].append(fut)
+        return fut
+
+    @classmethod
+    def _flush_reads(cls):
+        task = asyncio.ensure_future(cls._load_reads(_pending_reads.pop(cls)))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    @classmethod
+    async def _load_reads(cls, pending: dict):
+        try:
+            found = await cls.read_by_pks(pending)
+        except Exception as e:
+            found = [e] * len(pending)
+
+        for (pk, futures), result in zip(pending.items(), found):
+            if result is None:
+                result = IndexError(f'No {{cls._table}} with {{cls._pk}}={{pk!r}}')
+            for fut in futures:
+                if fut.done():
+                    continue
+                if isinstance(result, Exception):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+
+
+class UnitOfWork:
+    """ Collects creates, updates and deletes across tables and writes
+    them on `commit()` in one transaction, as one batch per table and
+    operation: creates (in the order tables were first seen), then
+    updates, then deletes (in reverse order). Used as an async context
+    manager, it commits on a clean exit and discards on an exception:
+
+        async with UnitOfWork() as uow:
+            uow.create(thing, name='a')
+            uow.update(other, name='b')
+            uow.delete_hard(old)
+
+    Created instances are in `created[cls]` after the commit. """
+
+    def __init__(self):
+        self._creates = defaultdict(list)  # cls -> [values]
+        self._updates = defaultdict(dict)  # cls -> {{pk: (obj, values)}}
+        self._deletes = defaultdict(dict)  # (cls, hard) -> {{pk: obj}}
+        self.created = defaultdict(list)
+
+    def create(self, cls, **values):
+        self._creates[cls].append(values)
+
+    def save(self, obj: CRUDTable):
+        """ Queue the object's `changes()`, if it has any. """
+        if obj._dirty:
+            self.update(obj, **obj.changes())
+
+    def update(self, obj: CRUDTable, **values):
+        """ Later updates to the same object are merged. """
+        pk = getattr(obj, obj._pk)
+        _, pending = self._updates[type(obj)].setdefault(pk, (obj, {{}}))
+        pending.update(values)
+
+    def delete(self, obj: CRUDTable):
+        self._deletes[type(obj), False][getattr(obj, obj._pk)] = obj
+
+    def delete_hard(self, obj: CRUDTable):
+        self._deletes[type(obj), True][getattr(obj, obj._pk)] = obj
+
+    def discard(self):
+        self._creates.clear()
+        self._updates.clear()
+        self._deletes.clear()
+
+    async def commit(self):
+        deleted_at = datetime.datetime.utcnow()
+        async with session():
+            for cls, rows in self._creates.items():
+                self.created[cls].extend(await cls.create_many(rows, returning=True))
+
+            for cls, pending in self._updates.items():
+                # One update_each() per distinct set of changed columns.
+                groups = defaultdict(list)
+                for pk, (obj, values) in pending.items():
+                    groups[tuple(sorted(values))].append((obj, values))
+                for fields, items in groups.items():
+                    await cls.update_each(
+                        [dict(values, **{{cls._pk: getattr(obj, cls._pk)}}) for obj, values in items],
+                        fields
+                    )
+
+            for (cls, hard), objs in reversed(list(self._deletes.items())):
+                await cls.delete_by_pks(objs, hard=hard, deleted_at=deleted_at)
+
+        # Only touch the instances once everything is written.
+        for pending in self._updates.values():
+            for obj, values in pending.values():
+                for f, v in values.items():
+                    setattr(obj, f, v)
+                    obj._dirty &= ~obj._update_bits[f]
+        for (cls, hard), objs in self._deletes.items():
+            if not hard:
+                for obj in objs.values():
+                    obj.deleted_at = deleted_at
+                    obj._dirty &= ~obj._update_bits.get('deleted_at', 0)
+        self.discard()
+
+    async def __aenter__(self) -> 'UnitOfWork':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        else:
+            self.discard()
+
+
 {enums}
 '''
 
@@ -144,12 +1479,15 @@ postgres_to_python_text = {
     'date': 'datetime.date',
     'time': 'datetime.time',
     'time with timezone': 'datetime.time',
+    'time with time zone': 'datetime.time',
     'time without time zone': 'datetime.time',
     'timestamp': 'datetime.datetime',
     'timestamp with timezone': 'datetime.datetime',
+    'timestamp with time zone': 'datetime.datetime',
     'timestamp without time zone': 'datetime.datetime',
     'interval': 'datetime.timedelta',
     'float': 'float',
+    'real': 'float',
     'double precision': 'float',
     'smallint': 'int',
     'integer': 'int',
@@ -166,130 +1504,292 @@ postgres_to_python_text = {
     'uuid': 'uuid.UUID',
 }
 
+# NumPy dtypes for read_columns(numpy=True), by the Python type above.
+# Other types, Decimal included, stay object arrays.
+python_text_to_numpy = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool',
+    'datetime.datetime': 'datetime64[us]',
+    'datetime.date': 'datetime64[D]',
+    'datetime.timedelta': 'timedelta64[us]',
+}
+
 
 TABLE_TEMPLATE = Template('''\
 # noinspection PyShadowingBuiltins,PyPep8Naming
 class ${table_name}(CRUDTable):
-    def __init__(self, *, $init_params):
+    _table = '${table_name}'
+    _schema = '${schema}'
+    _qualified_table = '${qualified_table}'
+    _pk = '${pk}'
+    _pk_pgtype = '$pk_pgtype'
+    _columns = $all_columns
+    _insert_fields = $insert_fields
+    _update_fields = $update_fields
+    _update_bits = $update_bits
+    _pgtypes = $pgtypes
+    _numpy_dtypes = $numpy_dtypes
+    _unique_keys = $unique_keys
+    _relations = $relations
+    _sql_cache = {}
+
+    def __init__(
+        self,
+        *,
+$init_params
+    ):
         """ This initializer is mainly for static type engines. Use one
         of the classmethods to create instances (with DB interaction) """
         super().__init__()
 $init_assignments
 
     @classmethod
-    async def create(cls, *, $create_params) -> '${table_name}':
-        async with pool.acquire() as conn:
+    def _from_record(cls, r) -> '${table_name}':
+        """ Build an instance from a full row, by position, skipping
+        __init__ and keyword argument handling. """
+        self = object.__new__(cls._untracked)
+        $record_targets = r
+        self._dirty = 0
+        self.__class__ = cls
+        return self
+
+    @classmethod
+    async def create(
+        cls,
+        *,
+$create_params
+    ) -> '${table_name}':
+        values = $create_values
+        async with _acquire('${table_name}', 'create') as conn:
             r = await conn.fetchrow("""\\
-                INSERT INTO ${table_name}
+                INSERT INTO ${qualified_table}
                     ($calc_fields)
                 VALUES (
                     $field_nums
                 ) RETURNING *
-            """, $calc_fields)
-            return cls(**r)
+            """, *values)
+            return cls._from_record(r)
 
     @classmethod
-    async def read(cls, *, $pk: $pktype) -> '${table_name}':
-        async with pool.acquire() as conn:
-            records = await conn.fetch("""\\
-                SELECT * FROM ${table_name}
-                WHERE
-                    ${table_name}.${pk} = $1
-            """, $pk)
+    async def upsert(
+        cls,
+        *,
+        conflict_on: Sequence[str] = None,
+$upsert_params
+    ) -> '${table_name}':
+        """ Insert the row, or update the existing row that conflicts with
+        it on `conflict_on`. The unique keys of this table are
+        $unique_keys_doc; by default the first one covered by the given
+        columns is used. Columns left UNCHANGED are neither inserted nor
+        updated. """
+        given = $all_values
+        values = {
+            f: v for f, v in zip(cls._columns, given) if v is not UNCHANGED
+        }
+        return await cls._upsert(values, conflict_on)
+
+    @classmethod
+    async def read(
+        cls, *, $pk: $pktype, columns: Sequence[str] = None
+    ) -> '${table_name}':
+        """ With `columns`, only those columns and the primary key are
+        fetched, and the other attributes are left unset. """
+        if columns is not None:
+            async with _acquire('${table_name}', 'read') as conn:
+                records = await conn.fetch(f"""\\
+                    SELECT {cls._select_list(columns)} FROM ${qualified_table}
+                    WHERE
+                        ${qualified_table}.${pk} = $1
+                """, $pk)
+
+            return cls._from_partial(records[0])
+
+        # Inside a session the cache is bypassed: it could hold rows the
+        # transaction has changed, and mustn't get any it hasn't committed.
+        in_session = _session_connection.get() is not None
+        cache = None if in_session else cls.cache
+        if cache is not None:
+            obj = cache.get($pk)
+            if obj is not None:
+                return obj
+
+        if cls.batch_reads and not in_session:
+            obj = await cls._batched_read($pk)
+        else:
+            async with _acquire('${table_name}', 'read') as conn:
+                records = await conn.fetch("""\\
+                    SELECT * FROM ${qualified_table}
+                    WHERE
+                        ${qualified_table}.${pk} = $1
+                """, $pk)
 
-            return cls(**records[0])
+            obj = cls._from_record(records[0])
+
+        if cache is not None:
+            cache.put($pk, obj)
+        return obj
 
     @classmethod
-    async def read_many(cls, where_clause: str = '', params: Sequence = ()) -> 'List[${table_name}]':
+    async def read_many(
+        cls,
+        where_clause: str = '',
+        params: Sequence = (),
+        columns: Sequence[str] = None,
+        as_view=False,
+    ) -> 'List[${table_name}]':
+        """ With `columns`, only those columns and the primary key are
+        fetched, and the other attributes are left unset. With `as_view`,
+        the rows are read-only RowViews over the fetched records rather
+        than instances. """
         final_where = ''
         if where_clause:
             final_where = f'\\nWHERE {where_clause}'
 
-        async with pool.acquire() as conn:
+        async with _acquire('${table_name}', 'read_many') as conn:
             records = await conn.fetch(f"""\\
-                SELECT * FROM ${table_name}{final_where}
+                SELECT {cls._select_list(columns)} FROM ${qualified_table}{final_where}
             """, *params)
 
-            return [cls(**r) for r in records]
-
-    async def update(self, *, $update_params):
-        sql_fields = []
-        sql_values = []
-        fieldnames = [$update_fieldnames]
-        fieldvalues = [$update_fieldvalues]
-        changed_fieldnames = []
-        changed_fieldvalues = []
-        count = 2
-        for f, v in zip(fieldnames, fieldvalues):
-            if v is UNCHANGED:
-                continue
-
-            changed_fieldnames.append(f)
-            changed_fieldvalues.append(v)
-
-            sql_fields.append(f'{f} = ${count}')
-            sql_values.append(v)
-            count += 1
-
-        async with pool.acquire() as conn:
-            await conn.execute(f"""\\
-                UPDATE ${table_name}
-                SET
-                    {', '.join(sql_fields)}
-                WHERE
-                    ${table_name}.${pk} = $1
-            """, self.$pk, *sql_values)
-
-        for f, v in zip(changed_fieldnames, changed_fieldvalues):
+            make = cls._row_factory(columns, as_view)
+            return [make(r) for r in records]
+
+    async def update(
+        self,
+        *,
+$update_params
+    ):
+        # The values are collected first, before any local could shadow a
+        # parameter of the same name.
+        values = $update_fieldvalues
+        mask = $update_mask
+        if not mask:
+            return
+
+        sql, fieldnames = self._update_sql(mask)
+        values = [v for v in values if v is not UNCHANGED]
+        async with _acquire('${table_name}', 'update') as conn:
+            await conn.execute(sql, self.$pk, *values)
+
+        for f, v in zip(fieldnames, values):
             setattr(self, f, v)
+        self._dirty &= ~mask
+
+        if self.cache is not None:
+            self._recache()
 
     @classmethod
-    async def update_many(cls, *, where_clause: str = '', where_params: Sequence = (), $update_params):
+    async def update_many(
+        cls,
+        *,
+        where_clause: str = '',
+        where_params: Sequence = (),
+$update_params
+    ):
         """ Parameters in the `where_clause` will start numbering at $1."""
-        final_where = ''
-        if where_clause:
-            final_where = f'\\nWHERE {where_clause}'
-
-        sql_fields = []
-        sql_values = []
-        fieldnames = [$update_fieldnames]
-        fieldvalues = [$update_fieldvalues]
-        count = 1 + len(where_params)
-        for f, v in zip(fieldnames, fieldvalues):
-            if v is UNCHANGED:
-                continue
+        values = $update_fieldvalues
+        mask = $update_mask
+        if not mask:
+            return
+
+        set_clause, _ = cls._set_clause(mask, 1 + len(where_params))
+        values = [v for v in values if v is not UNCHANGED]
+        async with _acquire('${table_name}', 'update_many') as conn:
+            await conn.execute(
+                f'UPDATE ${qualified_table}\\nSET {set_clause}{_where(where_clause)}',
+                *where_params, *values
+            )
 
-            sql_fields.append(f'{f} = ${count}')
-            sql_values.append(v)
-            count += 1
-
-        async with pool.acquire() as conn:
-            await conn.execute(f"""\\
-                UPDATE ${table_name}
-                SET
-                    {', '.join(sql_fields)}{final_where}
-            """, *where_params, *sql_values)
+        if cls.cache is not None:
+            cls.cache.clear()
 
     async def delete(self):
-        async with pool.acquire() as conn:
+        async with _acquire('${table_name}', 'delete') as conn:
             deleted_at = datetime.datetime.utcnow()
             await conn.execute(f"""\\
-                UPDATE ${table_name}
+                UPDATE ${qualified_table}
                 SET deleted_at = $2
                 WHERE
                     ${pk} = $1
             """, self.$pk, deleted_at)
         self.deleted_at = deleted_at
+        self._dirty &= ~self._update_bits.get('deleted_at', 0)
+
+        if self.cache is not None:
+            self._recache()
 
     async def delete_hard(self):
-        async with pool.acquire() as conn:
+        async with _acquire('${table_name}', 'delete_hard') as conn:
             await conn.execute(f"""\\
-                DELETE FROM ${table_name}
+                DELETE FROM ${qualified_table}
                 WHERE
-                    ${table_name}.${pk} = $1
+                    ${qualified_table}.${pk} = $1
             """, self.$pk)
+
+        if self.cache is not None:
+            self.cache.invalidate(self.$pk)
+$finder_methods$relation_methods''')
+
+# Accessors for the relations of a table, appended to its class.
+FORWARD_RELATION_TEMPLATE = Template('''
+    async def ${name}(self) -> '${table}':
+        """ The ${table} row that ${column} refers to, or None. """
+        return await self._load_related('${name}')
 ''')
 
+REVERSE_RELATION_TEMPLATE = Template('''
+    async def ${name}(self) -> 'List[${table}]':
+        """ The ${table} rows whose ${remote_column} refers to this row. """
+        return await self._load_related('${name}')
+''')
+
+# Finders for the columns of an index, in index order, appended to the
+# class of its table.
+UNIQUE_FINDER_TEMPLATE = Template('''
+    @classmethod
+    async def ${name}${signature} -> '${table_name}':
+        """ The row with the given ${described}, looked up through the
+        unique index ${index}. """
+        values = ${values}
+        async with _acquire('${table_name}', '${name}') as conn:
+            records = await conn.fetch("""\\
+                SELECT * FROM ${qualified_table}
+                WHERE
+                    ${conditions}
+            """, *values)
+
+        return cls._from_record(records[0])
+''')
+
+FINDER_TEMPLATE = Template('''
+    @classmethod
+    async def ${name}${signature} -> 'List[${table_name}]':
+        """ The rows with the given ${described}, looked up through
+        the index ${index}. `columns` and `as_view` work as for
+        read_many(). """
+        values = ${values}
+        async with _acquire('${table_name}', '${name}') as conn:
+            records = await conn.fetch(f"""\\
+                SELECT {cls._select_list(columns)} FROM ${qualified_table}
+                WHERE
+                    ${conditions}
+            """, *values)
+
+            make = cls._row_factory(columns, as_view)
+            return [make(r) for r in records]
+''')
+
+# Names a relation accessor must not take: attributes of the generated
+# classes, which are the methods and class attributes in the templates.
+RESERVED_NAMES = {
+    name
+    for names in re.findall(
+        r'^    (?:async )?def (\w+)|^    (\w+)(?::[^=\n]*)? = ',
+        header + TABLE_TEMPLATE.template, re.MULTILINE
+    )
+    for name in names if name
+}
+
 
 class Column(NamedTuple):
     name: str  # column_name
@@ -297,27 +1797,75 @@ class Column(NamedTuple):
     default: str = ''  # column_default
     nullstr: str = ''  # or it could be " = None"
     comment: str = ''
+    pgtype: str = ''  # udt_name, used for array casts
+    pgschema: str = 'pg_catalog'  # the schema of the type
 
 
-class Table(NamedTuple):
-    name: str  # table_name
-    columns: Dict[str, Column]
+class Index(NamedTuple):
+    name: str
+    table: str
+    columns: List[str]  # In index order
+    unique: bool
+    primary: bool
+    method: str  # btree, hash, gin, ...
 
 
-def comma_sep(columns: Iterable[Column], wrap='', filter_=lambda c: True) -> str:
-    return ', '.join(f'{wrap}{c.name}{wrap}' for c in columns if filter_(c))
+class Relation(NamedTuple):
+    name: str  # of the accessor method
+    many: bool  # one-to-many (reverse) rather than many-to-one (forward)
+    column: str  # on this table
+    table: str  # the other table
+    remote_column: str  # on the other table
+    constraint: str
 
 
-def comma_sep_type(columns: Iterable[Column], filter_=lambda c: True) -> str:
-    return ', '.join(f'{c.name}: {c.type}' for c in columns if filter_(c))
-
-
-def comma_sep_type_none(columns: Iterable[Column], filter_=lambda c: True) -> str:
-    return ', '.join(f'{c.name}: {c.type}{c.nullstr}' for c in columns if filter_(c))
-
-
-def comma_sep_type_def(columns: Iterable[Column], default=' = UNCHANGED', filter_=lambda c: True) -> str:
-    return ', '.join(f'{c.name}: {c.type}{default}' for c in columns if filter_(c))
+class Table(NamedTuple):
+    name: str  # table_name
+    columns: Dict[str, Column]
+    pk: str = ''
+    indexes: List[Index] = ()
+    relations: List[Relation] = ()
+    schema: str = 'public'
+
+
+# The parts of a table class that grow with the table (signatures, tuples
+# and dicts of columns, long expressions) are wrapped at this width. It is
+# not a limit on every line: SQL text, long index names and the header can
+# run past it. --format runs yapf over the output for that.
+LINE_WIDTH = 79
+
+
+def wrap_sequence(items: Sequence[str], indent: int, prefix: int, brackets='()') -> str:
+    """ `items` between `brackets`, on one line if that fits after
+    `prefix` characters, otherwise one item per line at `indent` + 4. A
+    one-item tuple keeps its trailing comma. """
+    open_, close = brackets
+    one_line = ', '.join(items) + (',' if len(items) == 1 and brackets == '()' else '')
+    if prefix + len(one_line) + 2 <= LINE_WIDTH:
+        return f'{open_}{one_line}{close}'
+    lines = ''.join(f'\n{" " * (indent + 4)}{item},' for item in items)
+    return f'{open_}{lines}\n{" " * indent}{close}'
+
+
+def wrap_expression(terms: Sequence[str], op: str, indent: int, prefix: int) -> str:
+    """ `terms` joined by the binary operator `op`, on one line if that
+    fits after `prefix` characters, otherwise parenthesized with one term
+    per line. """
+    one_line = f' {op} '.join(terms)
+    if prefix + len(one_line) <= LINE_WIDTH:
+        return one_line
+    pad = ' ' * (indent + 4)
+    lines = f'\n{pad}{op} '.join(terms)
+    return f'(\n{pad}{lines}\n{" " * indent})'
+
+
+def param_lines(columns: Iterable[Column], default: str = None, filter_=lambda c: True) -> str:
+    """ Keyword parameters for a generated method, one per line. Without
+    `default`, nullable columns default to None. """
+    return '\n'.join(
+        f'        {c.name}: {c.type}{c.nullstr if default is None else default},'
+        for c in columns if filter_(c)
+    )
 
 
 async def get_enums(conn: Connection) -> Dict[str, List[str]]:
@@ -345,35 +1893,82 @@ def generate_enum_code(enums_db: Dict[str, List[str]]) -> str:
     for enum_name, enum_values in enums_db.items():
         slug_enum_values = [slugify(v, separator='_') for v in enum_values]
         assignments = '\n'.join(
-            ' ' * 4 + f"{s}='{v}'" for s, v in zip(slug_enum_values, enum_values)
+            ' ' * 4 + f'{s} = {v!r}' for s, v in zip(slug_enum_values, enum_values)
         )
 
         code = f'# noinspection PyPep8Naming\nclass {enum_name}(Enum):\n{assignments}'
         enum_code.append(code)
 
-    return '\n\n'.join(enum_code)
-
+    return '\n\n\n'.join(enum_code)
 
-async def generate(conn: Connection, args):
-    table_skips = {'alembic_version'}
-    pkeys = await get_primary_keys(conn, args)
-    pprint(pkeys)
 
-    columns = await conn.fetch(f'''\
-        select *
-        from {args.db}.information_schema.columns
-        where table_schema = '{args.schema}';
-    ''')
+async def get_columns(conn: Connection, args) -> List[asyncpg.Record]:
+    """ The columns of the tables in the schema, in table and column
+    order. The values match what information_schema.columns gives, but
+    reading pg_catalog directly is much faster on large databases. """
+    sql = '''\
+    SELECT
+      c.relname AS table_name,
+      a.attname AS column_name,
+      CASE
+        WHEN t.typelem <> 0 AND t.typlen = -1 THEN 'ARRAY'
+        WHEN tn.nspname = 'pg_catalog' THEN format_type(t.oid, NULL)
+        ELSE 'USER-DEFINED'
+      END AS data_type,
+      t.typname AS udt_name,
+      tn.nspname AS udt_schema,
+      pg_get_expr(d.adbin, d.adrelid) AS column_default,
+      NOT a.attnotnull AS is_nullable
+    FROM pg_attribute a
+    JOIN pg_class c ON c.oid = a.attrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_type dt ON dt.oid = a.atttypid
+    -- Domains are described by their underlying type.
+    JOIN pg_type t ON t.oid = CASE WHEN dt.typtype = 'd' THEN dt.typbasetype ELSE dt.oid END
+    JOIN pg_namespace tn ON tn.oid = t.typnamespace
+    LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    WHERE n.nspname = $1
+      AND c.relkind IN ('r', 'p')
+      AND a.attnum > 0
+      AND NOT a.attisdropped
+    ORDER BY c.relname, a.attnum;
+    '''
+    return await conn.fetch(sql, args.schema)
+
+
+async def introspect(conn, args) -> Tuple[Dict[str, Table], Dict[str, List[str]]]:
+    """ Read the tables and enums of the schema. With a pool for `conn`
+    the catalog queries run concurrently; with a connection, one after
+    the other. """
+    queries = [
+        get_primary_keys(conn, args),
+        get_columns(conn, args),
+        get_indexes(conn, args),
+        get_enums(conn),
+        get_fk_data(conn, args),
+    ]
+    if isinstance(conn, Pool):
+        results = await asyncio.gather(*queries)
+    else:
+        results = [await q for q in queries]
+    pkeys, columns, indexes, enums, fks = results
+    logger.debug('Primary keys: %s', pkeys)
 
     tables: Dict[str, Table] = {}
 
     for c in columns:
-        print(c)
+        logger.debug('Column: %s', c)
         table_name = c['table_name']
+        if table_name not in pkeys:
+            continue
+
         if table_name not in tables:
             tables[table_name] = Table(
                 name=table_name,
-                columns=OrderedDict()
+                columns=OrderedDict(),
+                pk=pkeys[table_name],
+                indexes=indexes.get(table_name, []),
+                schema=args.schema,
             )
 
         colname = c['column_name']
@@ -395,111 +1990,373 @@ async def generate(conn: Connection, args):
             comment = f"  # Enum: {c['udt_name']}"
 
         else:
-            print(f'I failed to figure out the type for {c["data_type"]} '
-                  f'for column {colname} in table {table_name}. Setting '
-                  f'to "Any".')
+            logger.warning(
+                'I failed to figure out the type for %s for column %s in '
+                'table %s. Setting to "Any".', c['data_type'], colname, table_name
+            )
             type_ = 'Any'
 
         tables[table_name].columns[colname] = Column(
             name=colname,
             type=type_,
             default=c['column_default'],
-            nullstr=' = None' if c['is_nullable'] == 'YES' else '',
-            comment=comment
+            nullstr=' = None' if c['is_nullable'] else '',
+            comment=comment,
+            pgtype=c['udt_name'],
+            pgschema=c['udt_schema'],
         )
 
-    pprint(tables)
-
-    # Generate output
-    generated_classes = [
-        header.format(
-            autogentime=datetime.datetime.now().ctime(),
-            enums=generate_enum_code(await get_enums(conn))
+    skipped = {c['table_name'] for c in columns} - set(pkeys)
+    if skipped:
+        logger.warning('Skipping tables without a primary key: %s', ', '.join(sorted(skipped)))
+    add_relations(tables, fks)
+    logger.debug('Tables: %s', tables)
+    return tables, enums
+
+
+def add_relations(tables: Dict[str, Table], fks: List['ForeignKey']):
+    """ Give both tables of each foreign key a relation accessor.
+
+    On the referencing table, the many-to-one relation is named after
+    the column without its `_id` suffix, or else after the referenced
+    table. On the referenced table, the one-to-many relation is named
+    `<table>_set`. Names that clash with a column, a generated attribute
+    or an earlier relation get `_by_<column>` appended; if that clashes
+    too, the relation is left out. """
+    relations = defaultdict(list)
+    taken = {name: set(t.columns) | RESERVED_NAMES for name, t in tables.items()}
+
+    def add(table: str, relation: Relation, fallback: str):
+        for name in (relation.name, fallback):
+            if name not in taken[table]:
+                taken[table].add(name)
+                relations[table].append(relation._replace(name=name))
+                return
+        logger.warning(
+            'No free name for the relation %s on table %s, leaving it out.',
+            relation.constraint, table
         )
-    ]
 
-    for table_name in sorted(tables.keys()):
-        table = tables[table_name]
-        if table_name in table_skips:
+    for fk in fks:
+        source, target = fk.source_table, fk.target_table
+        if source not in tables or target not in tables:
             continue
+        column = fk.source_column
+        forward = column[:-3] if column.endswith('_id') and len(column) > 3 else target
+        add(source, Relation(
+            name=forward, many=False, column=column, table=target,
+            remote_column=fk.target_column, constraint=fk.constraint_name,
+        ), f'{target}_by_{column}')
+        add(target, Relation(
+            name=f'{source}_set', many=True, column=fk.target_column, table=source,
+            remote_column=column, constraint=fk.constraint_name,
+        ), f'{source}_set_by_{column}')
+
+    for name, rels in relations.items():
+        tables[name] = tables[name]._replace(relations=rels)
+
+
+def quote_ident(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def qualified_name(table: Table) -> str:
+    """ The quoted, schema-qualified name of `table`, so that statements
+    don't depend on the search_path. """
+    return f'{quote_ident(table.schema)}.{quote_ident(table.name)}'
+
+
+def cast_type(column: Column) -> str:
+    """ The type of `column` as written in casts. Types outside
+    pg_catalog, such as enums, are schema-qualified like the tables:
+    they need not be on the search_path either. """
+    if column.pgschema == 'pg_catalog':
+        return column.pgtype
+    return f'{quote_ident(column.pgschema)}.{quote_ident(column.pgtype)}'
+
+
+def render_finders(table: Table) -> str:
+    """ A finder per unique or btree index other than the primary key:
+    `read_by_<columns>()` returning one row for a unique index, and
+    `read_many_by_<columns>()` returning a list otherwise. """
+    taken = set(table.columns) | RESERVED_NAMES | {r.name for r in table.relations}
+    out = []
+    for ix in table.indexes:
+        if ix.primary or not (ix.unique or ix.method == 'btree'):
+            continue
+
+        prefix = 'read_by_' if ix.unique else 'read_many_by_'
+        name = prefix + '_'.join(ix.columns)
+        if name in taken:
+            logger.debug('Skipping the finder for index %s, %s is taken', ix.name, name)
+            continue
+        taken.add(name)
+
+        params = ['cls', '*'] + [f'{c}: {table.columns[c].type}' for c in ix.columns]
+        returns = f"'{table.name}'"
+        template = UNIQUE_FINDER_TEMPLATE
+        if not ix.unique:
+            params += ['columns: Sequence[str] = None', 'as_view=False']
+            returns = f"'List[{table.name}]'"
+            template = FINDER_TEMPLATE
+
+        out.append(template.safe_substitute(
+            table_name=table.name,
+            qualified_table=qualified_name(table),
+            name=name,
+            signature=wrap_sequence(
+                params, 4, len(f'    async def {name} -> {returns}:')
+            ),
+            described=' and '.join(ix.columns),
+            index=ix.name,
+            conditions='\n                    AND '.join(
+                f'{qualified_name(table)}.{c} = ${i + 1}' for i, c in enumerate(ix.columns)
+            ),
+            values=wrap_sequence(list(ix.columns), 8, len('        values = ')),
+        ))
+    return ''.join(out)
+
 
-        all_fields = []
-        all_fields_types = []
+def render_table(table: Table) -> str:
+    """ The generated class for one table. """
+    all_fields = []
+    all_fields_types = []
 
-        cu_fields = []
-        cu_fields_types = []
-        cu_args = []
-        cu_defaults = []
+    cu_fields = []
+    cu_fields_types = []
+    cu_args = []
+    cu_defaults = []
 
-        for cn, c in table.columns.items():
-            all_fields.append(c.name)
-            all_fields_types.append(c.type)
+    for cn, c in table.columns.items():
+        all_fields.append(c.name)
+        all_fields_types.append(c.type)
 
-            if c.default:
-                continue
+        if c.default:
+            continue
 
-            cu_fields.append(c.name)
-            cu_fields_types.append(c.type)
-            cu_args.append(f'{c.name}: {c.type} = UNCHANGED')
-            # cu_defaults.append(
-            #     f' = None' if c.is_nullable else ''
-            # )
+        cu_fields.append(c.name)
+        cu_fields_types.append(c.type)
+        cu_args.append(f'{c.name}: {c.type} = UNCHANGED')
+        # cu_defaults.append(
+        #     f' = None' if c.is_nullable else ''
+        # )
+
+        # if c.is_nullable:
+        #     default_none = ' = None'
+        # else:
+        #     default_none = ''
+        #     init_assignment = ' = {c.name}'
+
+    # Columns with a default are left out of create(), but can still be
+    # changed: every column is updatable except a primary key with a
+    # default, which is generated.
+    up_columns = [
+        c for c in table.columns.values() if not (c.default and c.name == table.pk)
+    ]
+    up_fields = [c.name for c in up_columns]
+
+    unique_keys = [ix for ix in table.indexes if ix.unique]
+
+    out = TABLE_TEMPLATE.safe_substitute(
+        table_name=table.name,
+        schema=table.schema,
+        qualified_table=qualified_name(table),
+
+        # init method
+        init_params=param_lines(table.columns.values()),
+        init_assignments=indent(
+            '\n'.join(f'self.{f} = {f}' for f in all_fields), ' '*4*2
+        ),
+
+        # create
+        create_params=param_lines(table.columns.values(), filter_=lambda _: not _.default),
+        create_values=wrap_sequence(cu_fields, 8, len('        values = ')),
+
+        # update
+        update_params=param_lines(up_columns, default=' = UNCHANGED'),
+        update_bits=wrap_sequence(
+            [f'{f!r}: {1 << i}' for i, f in enumerate(up_fields)],
+            4, len('    _update_bits = '), brackets='{}'
+        ),
+        update_mask=wrap_expression(
+            [f'({f} is not UNCHANGED) << {i}' for i, f in enumerate(up_fields)],
+            '|', 8, len('        mask = ')
+        ) or '0',
+        update_fieldvalues=wrap_sequence(up_fields, 8, len('        values = ')),
+        update_fields=wrap_sequence(
+            [repr(f) for f in up_fields], 4, len('    _update_fields = ')
+        ),
+
+        # Other
+        field_nums=', '.join(f'${i + 1}' for i in range(len(cu_fields))),
+        calc_fields=', '.join(cu_fields),
+        all_columns=wrap_sequence(
+            [repr(f) for f in all_fields], 4, len('    _columns = ')
+        ),
+        record_targets=wrap_sequence([f'self.{f}' for f in all_fields], 8, 8),
+        pgtypes=wrap_sequence(
+            [f'{c.name!r}: {cast_type(c)!r}' for c in table.columns.values()],
+            4, len('    _pgtypes = '), brackets='{}'
+        ),
+        unique_keys=wrap_sequence(
+            [wrap_sequence([repr(c) for c in ix.columns], 8, 8) for ix in unique_keys],
+            4, len('    _unique_keys = ')
+        ),
+        numpy_dtypes=wrap_sequence(
+            [f'{c.name!r}: {python_text_to_numpy[c.type]!r}'
+             for c in table.columns.values() if c.type in python_text_to_numpy],
+            4, len('    _numpy_dtypes = '), brackets='{}'
+        ),
+        relations=wrap_sequence(
+            [f'{r.name!r}: {(r.many, r.column, r.table, r.remote_column)!r}'
+             for r in table.relations],
+            4, len('    _relations = '), brackets='{}'
+        ),
+        finder_methods=render_finders(table),
+        relation_methods=''.join(
+            (REVERSE_RELATION_TEMPLATE if r.many else FORWARD_RELATION_TEMPLATE)
+            .safe_substitute(r._asdict())
+            for r in table.relations
+        ),
+        unique_keys_doc=', '.join(
+            f'({", ".join(ix.columns)})' for ix in unique_keys
+        ) or 'none',
+
+        # upsert
+        upsert_params=param_lines(table.columns.values(), default=' = UNCHANGED'),
+        all_values=wrap_sequence(all_fields, 8, len('        given = ')),
+        insert_fields=wrap_sequence(
+            [repr(f) for f in cu_fields], 4, len('    _insert_fields = ')
+        ),
+
+        pk=table.pk,
+        pktype=table.columns[table.pk].type,
+        pk_pgtype=cast_type(table.columns[table.pk]),
+    )
+    return out
 
-            # if c.is_nullable:
-            #     default_none = ' = None'
-            # else:
-            #     default_none = ''
-            #     init_assignment = ' = {c.name}'
 
-        out = TABLE_TEMPLATE.safe_substitute(
-            table_name=table_name,
+@lru_cache(maxsize=None)
+def generator_fingerprint() -> str:
+    """ Changes whenever the generator would emit different code for the
+    same table. That is any change to this module, not just to the
+    templates: the type mappings and rendering functions matter too. """
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def table_fingerprint(table: Table, enums: Dict[str, List[str]], formatted=False) -> str:
+    """ A stable hash of everything the generated code for `table`
+    depends on: its columns (names, types, defaults, nullability),
+    primary key, indexes, the enums it uses, the generator itself and
+    whether the code was run through yapf. """
+    used_enums = {
+        c.pgtype: enums[c.pgtype] for c in table.columns.values() if c.pgtype in enums
+    }
+    data = json.dumps(
+        [table, used_enums, generator_fingerprint(), formatted],
+        sort_keys=True, default=str
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
 
-            # init method
-            init_params=comma_sep_type_none(
-                table.columns.values()
-            ),
-            init_assignments=indent(
-                '\n'.join(f'self.{f} = {f}' for f in all_fields), ' '*4*2
-            ),
 
-            # create
-            create_params=comma_sep_type_none(
-                table.columns.values(),
-                filter_=lambda _: not _.default
-            ),
+def manifest_path(outfile: str) -> str:
+    return outfile + '.manifest.json'
 
-            # update
-            update_params=comma_sep_type_def(
-                table.columns.values(),
-                filter_=lambda _: not _.default
-            ),
-            update_fieldnames=comma_sep(
-                table.columns.values(),
-                wrap="'",
-                filter_=lambda _: not _.default
-            ),
-            update_fieldvalues=comma_sep(
-                table.columns.values(),
-                filter_=lambda _: not _.default
-            ),
 
-            # Other
-            field_nums=', '.join(f'${i + 1}' for i in range(len(cu_fields))),
-            calc_fields=', '.join(cu_fields),
+def load_manifest(path: str) -> dict:
+    """ The per-table fingerprints and code from the previous run. """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning('Ignoring unreadable manifest %s', path)
+        return {}
+    return manifest.get('tables', {})
+
+
+def save_manifest(path: str, entries: dict):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'version': __version__, 'tables': entries}, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
 
-            pk=pkeys[table_name],
-            pktype=tables[table_name].columns[pkeys[table_name]].type,
-        )
-        print()
-        print(out)
-        generated_classes.append(out)
-        print()
 
-    src = '\n\n'.join(generated_classes)
+def format_code(src: str) -> str:
     from yapf.yapflib.yapf_api import FormatCode
     src, _ = FormatCode(src)
+    return src
+
+
+async def format_sources(sources: List[str], jobs: int = None,
+                         executor: ProcessPoolExecutor = None) -> List[str]:
+    """ Run yapf over each of `sources` on a process pool: `executor` if
+    given, else a new one with `jobs` workers (one per core by
+    default). """
+    if not sources:
+        return []
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return await format_sources(sources, executor=executor)
+    loop = asyncio.get_event_loop()
+    return await asyncio.gather(
+        *(loop.run_in_executor(executor, format_code, src) for src in sources)
+    )
+
+
+async def generate(conn, args, executor: ProcessPoolExecutor = None):
+    table_skips = {'alembic_version'}
+    tables, enums = await introspect(conn, args)
+    formatted = getattr(args, 'format', False)
+
+    # Tables whose fingerprint matches the manifest from the previous run
+    # reuse the code emitted then.
+    path = manifest_path(args.outfile)
+    previous = {} if getattr(args, 'no_cache', False) else load_manifest(path)
+    entries = {}
+    rendered = {}
+
+    # Generate output. The templates wrap the per-table parts themselves
+    # (see LINE_WIDTH); yapf only runs when asked for.
+    top = header.format(
+        autogentime=datetime.datetime.now().ctime(),
+        enums=generate_enum_code(enums)
+    )
+
+    for table_name in sorted(tables.keys()):
+        table = tables[table_name]
+        if table_name in table_skips:
+            continue
+
+        fingerprint = table_fingerprint(table, enums, formatted)
+        entry = previous.get(table_name)
+        if entry and entry['fingerprint'] == fingerprint:
+            entries[table_name] = entry
+        else:
+            entries[table_name] = dict(fingerprint=fingerprint, code=None)
+            rendered[table_name] = render_table(table)
+
+    if formatted:
+        top, *codes = await format_sources(
+            [top, *rendered.values()], getattr(args, 'jobs', None), executor
+        )
+        rendered = dict(zip(rendered, codes))
+
+    for table_name, out in rendered.items():
+        logger.debug('Generated %s:\n%s', table_name, out)
+        entries[table_name]['code'] = out
+
+    logger.info(
+        'Generated %d tables, reused %d unchanged',
+        len(rendered), len(entries) - len(rendered)
+    )
+    chunks = [top] + [entry['code'] for entry in entries.values()]
+    src = '\n\n\n'.join(chunk.strip('\n') for chunk in chunks) + '\n'
     with open(args.outfile, 'w') as f:
         f.write(src)
+    save_manifest(path, entries)
 
     # await conn.execute('''
     #     CREATE TABLE users(
@@ -521,41 +2378,212 @@ async def generate(conn: Connection, args):
     # # asyncpg.Record(id=1, name='Bob', dob=datetime.date(1984, 3, 1))
 
 
-async def main(args):
-    dsn = f'postgresql://{args.user}:{args.password}@{args.host}:{args.port}/{args.db}'
-    conn: Connection = await asyncpg.connect(dsn)
+def split_names(value) -> List[str]:
+    """ Names from a comma separated string, or a list of such strings. """
+    if isinstance(value, str):
+        value = [value]
+    return [n.strip() for v in value or () for n in v.split(',') if n.strip()]
+
+
+def is_glob(name: str) -> bool:
+    return any(ch in name for ch in '*?[')
+
+
+def match_names(patterns: List[str], names: Iterable[str]) -> List[str]:
+    """ Expand the glob `patterns` against `names`, keeping the order of
+    the patterns. Plain names are kept as given. """
+    out = []
+    for p in patterns:
+        matches = sorted(n for n in names if fnmatchcase(n, p)) if is_glob(p) else [p]
+        out.extend(m for m in matches if m not in out)
+    return out
+
+
+def output_path(outfile: str, db: str, schema: str, multiple: bool) -> str:
+    """ Where the code for one schema goes. `outfile` may contain {db}
+    and {schema}; otherwise, when generating for more than one schema,
+    they are appended to its name. """
+    if '{' in outfile:
+        return outfile.format(db=db, schema=schema)
+    if not multiple:
+        return outfile
+    root, ext = os.path.splitext(outfile)
+    return f'{root}_{db}_{schema}{ext}'
+
+
+def make_dsn(args, db: str) -> str:
+    return f'postgresql://{args.user}:{args.password}@{args.host}:{args.port}/{db}'
+
+
+async def list_databases(args, databases: List[str]) -> List[str]:
+    if not any(map(is_glob, databases)):
+        return databases
+    # Any database we can connect to will do for reading pg_database.
+    plain = [d for d in databases if not is_glob(d)]
+    conn = await asyncpg.connect(make_dsn(args, plain[0] if plain else 'postgres'))
     try:
-        await generate(conn, args)
+        records = await conn.fetch(
+            'SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate'
+        )
     finally:
         await conn.close()
+    return match_names(databases, [r['datname'] for r in records])
+
+
+async def list_schemas(conn, schemas: List[str]) -> List[str]:
+    if not any(map(is_glob, schemas)):
+        return schemas
+    records = await conn.fetch(
+        "SELECT nspname FROM pg_namespace "
+        "WHERE nspname NOT LIKE 'pg\\_%' AND nspname <> 'information_schema'"
+    )
+    return match_names(schemas, [r['nspname'] for r in records])
+
+
+async def resolve_schemas(args, db: str, schemas: List[str], pools: asyncio.Semaphore) -> List[str]:
+    """ The schemas of `db` that `schemas` names, connecting only when
+    there are patterns to match. """
+    if not any(map(is_glob, schemas)):
+        return schemas
+    async with pools:
+        conn = await asyncpg.connect(make_dsn(args, db))
+        try:
+            return await list_schemas(conn, schemas)
+        finally:
+            await conn.close()
+
+
+async def generate_database(args, db: str, schemas: List[str], multiple: bool,
+                            limit: asyncio.Semaphore, pools: asyncio.Semaphore,
+                            executor=None):
+    """ Generate the code for each of `schemas` in `db`, sharing one
+    pool, no more than `limit` schemas at a time across all databases.
+    `pools` bounds the number of databases with a pool open. """
+    async with pools:
+        # Enough connections to run the catalog queries side by side.
+        pool: Pool = await asyncpg.create_pool(make_dsn(args, db), min_size=1, max_size=4)
+        try:
+            async def one(schema):
+                target = copy(args)
+                target.db, target.schema = db, schema
+                target.outfile = output_path(args.outfile, db, schema, multiple)
+                async with limit:
+                    logger.info('Generating %s.%s into %s', db, schema, target.outfile)
+                    await generate(pool, target, executor)
+
+            results = await asyncio.gather(*map(one, schemas), return_exceptions=True)
+        finally:
+            await pool.close()
+
+    for schema, r in zip(schemas, results):
+        if isinstance(r, Exception):
+            logger.error('Generating %s.%s failed: %r', db, schema, r)
+    return [r for r in results if isinstance(r, Exception)]
+
+
+async def main(args):
+    """ Generate the code for every schema in every database given by
+    `args.db` and `args.schema`, which are names or glob patterns. """
+    databases = await list_databases(args, split_names(args.db))
+    schemas = split_names(args.schema)
+    multiple = len(databases) > 1 or len(schemas) > 1 or any(map(is_glob, schemas))
+    concurrency = getattr(args, 'concurrency', 4)
+    limit = asyncio.Semaphore(concurrency)
+    pools = asyncio.Semaphore(concurrency)
+
+    found = await asyncio.gather(*(
+        resolve_schemas(args, db, schemas, pools) for db in databases
+    ))
+    # Two schemas writing to one file would overwrite each other, and
+    # the manifest, so an outfile pattern must tell them apart.
+    sources = defaultdict(list)
+    for db, names in zip(databases, found):
+        for schema in names:
+            sources[output_path(args.outfile, db, schema, multiple)].append(f'{db}.{schema}')
+    clashes = {path: names for path, names in sources.items() if len(names) > 1}
+    if clashes:
+        raise ValueError(
+            f'Several schemas would be written to the same file, add {{db}} '
+            f'or {{schema}} to the outfile: {clashes}'
+        )
+
+    # One process pool for formatting, shared by all schemas.
+    executor = None
+    if getattr(args, 'format', False):
+        executor = ProcessPoolExecutor(max_workers=getattr(args, 'jobs', None))
+    try:
+        errors = await asyncio.gather(*(
+            generate_database(args, db, names, multiple, limit, pools, executor)
+            for db, names in zip(databases, found)
+        ))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    errors = [e for errs in errors for e in errs]
+    if errors:
+        raise errors[0]
 
 
 async def get_primary_keys(conn: Connection, args) -> Dict[str, str]:
-    sql = f'''\
-    SELECT  *
-    FROM    {args.db}.INFORMATION_SCHEMA.TABLES t
-             LEFT JOIN INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
-                     ON tc.table_catalog = t.table_catalog
-                     AND tc.table_schema = t.table_schema
-                     AND tc.table_name = t.table_name
-                     AND tc.constraint_type = 'PRIMARY KEY'
-             LEFT JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
-                     ON kcu.table_catalog = tc.table_catalog
-                     AND kcu.table_schema = tc.table_schema
-                     AND kcu.table_name = tc.table_name
-                     AND kcu.constraint_name = tc.constraint_name
-    WHERE   t.table_schema NOT IN ('pg_catalog', 'information_schema')
-    ORDER BY t.table_catalog,
-             t.table_schema,
-             t.table_name,
-             kcu.constraint_name,
-             kcu.ordinal_position;
+    """ The primary key column of each table in the schema. For a
+    composite key, its first column. """
+    sql = '''\
+    SELECT
+      t.relname AS table_name,
+      a.attname AS column_name
+    FROM pg_index ix
+    JOIN pg_class t ON t.oid = ix.indrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ix.indkey[0]
+    WHERE n.nspname = $1
+      AND ix.indisprimary;
     '''
+    records = await conn.fetch(sql, args.schema)
+    return {r['table_name']: r['column_name'] for r in records}
 
-    records = await conn.fetch(sql)
-    out = {}
+
+async def get_indexes(conn: Connection, args) -> Dict[str, List[Index]]:
+    """ Indexes on plain columns, per table, with the primary key first.
+    Only key columns are listed, not INCLUDE columns. Partial and
+    expression indexes are left out, and so are deferrable unique
+    constraints, which can't be ON CONFLICT targets. """
+    sql = '''\
+    SELECT
+      t.relname AS table_name,
+      i.relname AS index_name,
+      ix.indisunique,
+      ix.indisprimary,
+      am.amname,
+      array_agg(a.attname ORDER BY k.ord) AS columns
+    FROM pg_index ix
+    JOIN pg_class t ON t.oid = ix.indrelid
+    JOIN pg_class i ON i.oid = ix.indexrelid
+    JOIN pg_am am ON am.oid = i.relam
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    CROSS JOIN LATERAL unnest(ix.indkey) WITH ORDINALITY AS k(attnum, ord)
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+    WHERE n.nspname = $1
+      AND k.ord <= ix.indnkeyatts
+      AND ix.indimmediate
+      AND ix.indpred IS NULL
+      AND ix.indexprs IS NULL
+    GROUP BY t.relname, i.relname, ix.indisunique, ix.indisprimary, am.amname
+    ORDER BY t.relname, ix.indisprimary DESC, i.relname;
+    '''
+    records = await conn.fetch(sql, args.schema)
+    out = defaultdict(list)
     for r in records:
-        out[r['table_name']] = r['column_name']
+        out[r['table_name']].append(
+            Index(
+                name=r['index_name'],
+                table=r['table_name'],
+                columns=list(r['columns']),
+                unique=r['indisunique'],
+                primary=r['indisprimary'],
+                method=r['amname'],
+            )
+        )
     return out
 
 
@@ -565,9 +2593,11 @@ def entrypoint():
 
     parser = ArgumentParser(description=__doc__, formatter_class=Formatter)
     parser.add_argument(
-        '--db', type=str, help='Database name')
+        '--db', type=str,
+        help='Database name, or a comma separated list of names and glob patterns')
     parser.add_argument(
-        '--schema', type=str, help='Schema', default='public')
+        '--schema', type=str, default='public',
+        help='Schema, or a comma separated list of names and glob patterns')
     parser.add_argument(
         '--user', type=str, default='postgres',
         help='database username')
@@ -584,8 +2614,29 @@ def entrypoint():
     )
     parser.add_argument(
         '-o', '--outfile', default='generated.py',
-        help='output filename'
-
+        help='output filename. It may contain {db} and {schema}; otherwise, '
+             'with several schemas, these are appended to the name'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=4,
+        help='schemas introspected and generated, and databases connected '
+             'to, at the same time'
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='regenerate every table, ignoring the manifest of the last run'
+    )
+    parser.add_argument(
+        '--format', action='store_true',
+        help='also run yapf over the generated code, one table per process'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='processes used by --format (default: one per core)'
+    )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='log the introspected schema and generated code'
     )
 
     if len(sys.argv) == 1:
@@ -593,6 +2644,12 @@ def entrypoint():
         sys.exit(1)
 
     args = parser.parse_args()
+    if args.format:
+        try:
+            import yapf
+        except ImportError:
+            parser.error('--format needs yapf: pip install pg_crud_gen[format]')
+    logging.basicConfig(level='DEBUG' if args.verbose else 'INFO')
     loop = asyncio.get_event_loop()
     loop.run_until_complete(main(args))
 
@@ -607,23 +2664,31 @@ class ForeignKey(NamedTuple):
     target_column: str
 
 
-async def get_fk_data(connection: Connection) -> List[ForeignKey]:
+async def get_fk_data(conn: Connection, args) -> List[ForeignKey]:
+    """ The single-column foreign keys between tables of the schema. """
     sql = '''\
     SELECT
       o.conname AS constraint_name,
-      (SELECT nspname FROM pg_namespace WHERE oid=m.relnamespace) AS source_schema,
-      m.relname AS source_table,
-      (SELECT a.attname FROM pg_attribute a WHERE a.attrelid = m.oid AND a.attnum = o.conkey[1] AND a.attisdropped = false) AS source_column,
-      (SELECT nspname FROM pg_namespace WHERE oid=f.relnamespace) AS target_schema,
-      f.relname AS target_table,
-      (SELECT a.attname FROM pg_attribute a WHERE a.attrelid = f.oid AND a.attnum = o.confkey[1] AND a.attisdropped = false) AS target_column
-    FROM
-      pg_constraint o LEFT JOIN pg_class c ON c.oid = o.conrelid
-      LEFT JOIN pg_class f ON f.oid = o.confrelid LEFT JOIN pg_class m ON m.oid = o.conrelid
-    WHERE
-      o.contype = 'f' AND o.conrelid IN (SELECT oid FROM pg_class c WHERE c.relkind = 'r');
+      sn.nspname AS source_schema,
+      s.relname AS source_table,
+      sa.attname AS source_column,
+      tn.nspname AS target_schema,
+      t.relname AS target_table,
+      ta.attname AS target_column
+    FROM pg_constraint o
+    JOIN pg_class s ON s.oid = o.conrelid
+    JOIN pg_namespace sn ON sn.oid = s.relnamespace
+    JOIN pg_class t ON t.oid = o.confrelid
+    JOIN pg_namespace tn ON tn.oid = t.relnamespace
+    JOIN pg_attribute sa ON sa.attrelid = s.oid AND sa.attnum = o.conkey[1]
+    JOIN pg_attribute ta ON ta.attrelid = t.oid AND ta.attnum = o.confkey[1]
+    WHERE o.contype = 'f'
+      AND cardinality(o.conkey) = 1
+      AND sn.nspname = $1
+      AND tn.nspname = $1
+    ORDER BY s.relname, sa.attnum, o.conname;
     '''
-    records = await connection.fetch(sql)
+    records = await conn.fetch(sql, args.schema)
     results = []
     for r in records:
         results.append(
@@ -1,9 +1,13 @@
+import asyncio
 import os
+from collections import OrderedDict
 from contextlib import contextmanager
 from typing import List, Optional, Tuple
 from uuid import uuid4
+from types import SimpleNamespace
 
 import datetime
+from decimal import Decimal
 import pytest
 import asyncpg
 import pg_crud_gen
@@ -104,3 +108,1079 @@ def run_cli(params: Optional[str] = '') -> Tuple[bool, str]:
     executable_path = Path(__file__).parent.parent.joinpath('pg_crud_gen.py')
     out = sp.run(['python', executable_path] + params.split())
     return out.returncode == 0, out.stdout
+
+
+def load_generated(loop, pool, db_params, schema='public'):
+    """ Run the generator against `schema` of the test database and
+    import the output as a module that uses `pool`. """
+    import importlib.util
+    import tempfile
+    from types import SimpleNamespace
+
+    outfile = os.path.join(tempfile.mkdtemp(), 'generated_test.py')
+    args = SimpleNamespace(outfile=outfile, db='crudtest', schema=schema, **db_params)
+    loop.run_until_complete(pg_crud_gen.main(args))
+
+    spec = importlib.util.spec_from_file_location('generated_test', outfile)
+    generated = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(generated)
+    generated.pool = pool
+    return generated
+
+
+def test_create_many(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+
+    rows = [dict(sample_text=f'row {i}', sample_int=i) for i in range(25)]
+    count = loop.run_until_complete(
+        generated.demo.create_many(rows, chunk_size=10)
+    )
+    assert count == 25
+
+    created = loop.run_until_complete(
+        generated.demo.create_many(rows[:3], returning=True, chunk_size=2)
+    )
+    assert [d.sample_int for d in created] == [0, 1, 2]
+    assert all(d.id for d in created)
+
+    records = loop.run_until_complete(pool.fetch('SELECT * FROM demo'))
+    assert len(records) == 28
+
+    # A misspelt column, or one left to its default, is refused.
+    for bad in [dict(sample_txt='typo'), dict(id=999, sample_int=1)]:
+        for returning in (False, True):
+            with pytest.raises(ValueError):
+                loop.run_until_complete(
+                    generated.demo.create_many([rows[0], bad], returning=returning)
+                )
+    assert loop.run_until_complete(generated.demo.count()) == 28
+
+
+def test_iter_many(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    rows = [dict(sample_text=f'row {i}', sample_int=i) for i in range(50)]
+    loop.run_until_complete(generated.demo.create_many(rows))
+
+    async def consume(where_clause='', params=(), stop_at=None):
+        out = []
+        agen = generated.demo.iter_many(where_clause, params, prefetch=7)
+        async for d in agen:
+            out.append(d)
+            if len(out) == stop_at:
+                break
+        await agen.aclose()
+        return out
+
+    items = loop.run_until_complete(consume('sample_int >= $1', [10]))
+    assert sorted(d.sample_int for d in items) == list(range(10, 50))
+
+    items = loop.run_until_complete(consume(stop_at=3))
+    assert len(items) == 3
+    # The connection went back to the pool, outside any transaction.
+    assert loop.run_until_complete(pool.fetchval('SELECT count(*) FROM demo')) == 50
+
+
+def test_page(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    rows = [dict(sample_text=f'row {i % 3}', sample_int=i) for i in range(10)]
+    loop.run_until_complete(generated.demo.create_many(rows))
+
+    async def all_pages(**kwargs):
+        pages = []
+        after = None
+        while True:
+            page = await generated.demo.page(after=after, limit=4, **kwargs)
+            pages.append([d.sample_int for d in page.items])
+            if page.after is None:
+                return pages
+            after = page.after
+
+    assert loop.run_until_complete(all_pages()) == [
+        [0, 1, 2, 3], [4, 5, 6, 7], [8, 9]
+    ]
+    assert loop.run_until_complete(all_pages(descending=True)) == [
+        [9, 8, 7, 6], [5, 4, 3, 2], [1, 0]
+    ]
+    assert loop.run_until_complete(
+        all_pages(order_by='sample_text', where_clause='sample_int < $1', params=[9])
+    ) == [[0, 3, 6, 1], [4, 7, 2, 5], [8]]
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(generated.demo.page(order_by='nope'))
+
+
+def test_read_by_pks(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    rows = [dict(sample_int=i) for i in range(5)]
+    created = loop.run_until_complete(
+        generated.demo.create_many(rows, returning=True)
+    )
+    ids = [d.id for d in created]
+
+    found = loop.run_until_complete(
+        generated.demo.read_by_pks([ids[3], -1, ids[0]])
+    )
+    assert found[0].sample_int == 3
+    assert found[1] is None
+    assert found[2].sample_int == 0
+
+    # With batching on, concurrent reads share one query.
+    from types import SimpleNamespace
+    acquires = []
+    generated.pool = SimpleNamespace(
+        acquire=lambda: acquires.append(1) or pool.acquire()
+    )
+    generated.demo.batch_reads = True
+
+    async def fan_out():
+        return await asyncio.gather(
+            *(generated.demo.read(id=i) for i in reversed(ids)),
+            generated.demo.read(id=-1),
+            return_exceptions=True
+        )
+
+    results = loop.run_until_complete(fan_out())
+    assert [d.sample_int for d in results[:-1]] == [4, 3, 2, 1, 0]
+    assert isinstance(results[-1], IndexError)
+    assert len(acquires) == 1
+
+
+def test_read_cache(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    created = loop.run_until_complete(generated.demo.create_many(
+        [dict(sample_int=i) for i in range(3)], returning=True
+    ))
+    cache = generated.demo.cache = generated.ReadCache(maxsize=2, ttl=60)
+
+    async def read(d):
+        return await generated.demo.read(id=d.id)
+
+    first = loop.run_until_complete(read(created[0]))
+    assert loop.run_until_complete(read(created[0])) is first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    loop.run_until_complete(read(created[1]))
+    loop.run_until_complete(read(created[2]))
+    assert cache.evictions == 1
+    assert loop.run_until_complete(read(created[0])) is not first
+
+    # Writes keep the cache in step with the table.
+    obj = loop.run_until_complete(read(created[0]))
+    loop.run_until_complete(obj.update(sample_int=100))
+    assert loop.run_until_complete(read(created[0])).sample_int == 100
+
+    loop.run_until_complete(generated.demo.update_many(sample_int=7))
+    assert loop.run_until_complete(read(created[0])).sample_int == 7
+
+    loop.run_until_complete(obj.delete_hard())
+    with pytest.raises(IndexError):
+        loop.run_until_complete(read(created[0]))
+
+
+def test_read_cache_partial_update(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    demo = generated.demo
+    demo.cache = generated.ReadCache()
+
+    async def scenario():
+        obj = await demo.create(sample_int=1, sample_text='a')
+        await demo.read(id=obj.id)
+
+        # A projected instance must not take the place of the full row.
+        partial = await demo.read(id=obj.id, columns=['sample_int'])
+        await partial.update(sample_int=2)
+        full = await demo.read(id=obj.id)
+        assert (full.sample_int, full.sample_text) == (2, 'a')
+
+        view = (await demo.read_many('id = $1', [obj.id], columns=['sample_int'], as_view=True))[0]
+        await view.update(sample_int=3)
+        full = await demo.read(id=obj.id)
+        assert (full.sample_int, full.sample_text) == (3, 'a')
+
+    loop.run_until_complete(scenario())
+
+
+def test_read_cache_session_rollback(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    demo = generated.demo
+    demo.cache = generated.ReadCache()
+
+    async def scenario():
+        obj = await demo.create(sample_text='t')
+        await demo.read(id=obj.id)
+
+        with pytest.raises(RuntimeError):
+            async with generated.session():
+                inside = await demo.read(id=obj.id)
+                await inside.update(sample_text='rolled back')
+                assert (await demo.read(id=obj.id)).sample_text == 'rolled back'
+                raise RuntimeError
+
+        assert (await demo.read(id=obj.id)).sample_text == 't'
+
+        # Committed writes still reach the cache on the next read.
+        async with generated.session():
+            inside = await demo.read(id=obj.id)
+            await inside.update(sample_text='committed')
+        assert (await demo.read(id=obj.id)).sample_text == 'committed'
+
+    loop.run_until_complete(scenario())
+
+
+def test_update_sql_cache(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    obj = loop.run_until_complete(generated.demo.create(sample_int=1))
+
+    loop.run_until_complete(obj.update(sample_int=2, sample_text='a'))
+    loop.run_until_complete(obj.update(sample_int=3, sample_text='b'))
+    loop.run_until_complete(obj.update())
+    assert len(generated.demo._sql_cache) == 2  # The SET clause and UPDATE
+
+    fetched = loop.run_until_complete(generated.demo.read(id=obj.id))
+    assert (fetched.sample_int, fetched.sample_text) == (3, 'b')
+
+    loop.run_until_complete(generated.demo.update_many(
+        where_clause='id = $1', where_params=[obj.id], sample_text='c'
+    ))
+    fetched = loop.run_until_complete(generated.demo.read(id=obj.id))
+    assert (fetched.sample_int, fetched.sample_text) == (3, 'c')
+
+
+def test_update_each(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    objs = loop.run_until_complete(generated.demo.create_many(
+        [dict(sample_int=i, sample_text='old') for i in range(10)], returning=True
+    ))
+
+    for o in objs:
+        o.sample_int *= 10
+    count = loop.run_until_complete(
+        generated.demo.update_each(objs, fields=['sample_int'], chunk_size=3)
+    )
+    assert count == 10
+
+    count = loop.run_until_complete(generated.demo.update_each(
+        [dict(id=o.id, sample_text=f'new {i}') for i, o in enumerate(objs[:4])]
+    ))
+    assert count == 4
+
+    records = loop.run_until_complete(
+        pool.fetch('SELECT sample_int, sample_text FROM demo ORDER BY id')
+    )
+    assert [r['sample_int'] for r in records] == [i * 10 for i in range(10)]
+    assert [r['sample_text'] for r in records][3:5] == ['new 3', 'old']
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(generated.demo.update_each(objs, fields=['id']))
+
+
+def test_upsert(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute(
+        'CREATE UNIQUE INDEX demo_sample_text_idx ON demo (sample_text)'
+    ))
+    generated = load_generated(loop, pool, db_params)
+    assert generated.demo._unique_keys == (('id',), ('sample_text',))
+
+    a = loop.run_until_complete(generated.demo.upsert(sample_text='a', sample_int=1))
+    b = loop.run_until_complete(generated.demo.upsert(sample_text='a', sample_int=2))
+    assert a.id == b.id and b.sample_int == 2
+    c = loop.run_until_complete(generated.demo.upsert(
+        id=a.id, sample_text='c', conflict_on=['id']
+    ))
+    assert c.id == a.id and (c.sample_text, c.sample_int) == ('c', 2)
+
+    rows = [dict(sample_text=t, sample_int=i) for i, t in enumerate('cdef')]
+    count = loop.run_until_complete(generated.demo.upsert_many(rows, chunk_size=3))
+    assert count == 4
+    out = loop.run_until_complete(generated.demo.upsert_many(
+        [dict(sample_text='f', sample_int=50)], returning=True
+    ))
+    assert out[0].sample_int == 50
+
+    records = loop.run_until_complete(
+        pool.fetch('SELECT sample_text, sample_int FROM demo ORDER BY sample_text')
+    )
+    assert [tuple(r) for r in records] == [('c', 0), ('d', 1), ('e', 2), ('f', 50)]
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(generated.demo.upsert(sample_int=1))
+
+
+def test_column_projection(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    obj = loop.run_until_complete(
+        generated.demo.create(sample_int=1, sample_text='wide')
+    )
+
+    partial = loop.run_until_complete(
+        generated.demo.read(id=obj.id, columns=['sample_int'])
+    )
+    assert (partial.id, partial.sample_int) == (obj.id, 1)
+    with pytest.raises(AttributeError, match='not loaded'):
+        partial.sample_text
+    assert 'sample_text' not in repr(partial)
+
+    items = loop.run_until_complete(
+        generated.demo.read_many('id = $1', [obj.id], columns=('sample_text',))
+    )
+    assert items[0].sample_text == 'wide'
+    assert not hasattr(items[0], 'sample_int')
+
+    async def stream():
+        return [d async for d in generated.demo.iter_many(columns=['sample_int'])]
+
+    assert loop.run_until_complete(stream())[0].sample_int == 1
+
+    # Partial instances can still be written back.
+    loop.run_until_complete(partial.update(sample_int=2))
+    assert loop.run_until_complete(generated.demo.read(id=obj.id)).sample_int == 2
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(generated.demo.read(id=obj.id, columns=['nope']))
+
+
+def test_row_views(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    loop.run_until_complete(generated.demo.create_many(
+        [dict(sample_int=i, sample_text=f'row {i}') for i in range(3)]
+    ))
+
+    views = loop.run_until_complete(generated.demo.read_many(as_view=True))
+    assert all(isinstance(v, generated.RowView) for v in views)
+    assert sorted(v.sample_int for v in views) == [0, 1, 2]
+    with pytest.raises(AttributeError):
+        views[0].sample_int = 5
+
+    obj = loop.run_until_complete(views[0].update(sample_text='changed'))
+    assert isinstance(obj, generated.demo)
+    assert loop.run_until_complete(generated.demo.read(id=obj.id)).sample_text == 'changed'
+
+    views = loop.run_until_complete(
+        generated.demo.read_many(columns=['sample_int'], as_view=True)
+    )
+    with pytest.raises(AttributeError, match='not loaded'):
+        views[0].sample_text
+    assert not hasattr(views[0].load(), 'sample_text')
+
+    async def stream():
+        return [v async for v in generated.demo.iter_many(as_view=True)]
+
+    assert len(loop.run_until_complete(stream())) == 3
+
+
+def test_session(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+
+    from types import SimpleNamespace
+    acquires = []
+    generated.pool = SimpleNamespace(
+        acquire=lambda: acquires.append(1) or pool.acquire()
+    )
+
+    async def work(fail=False):
+        async with generated.session() as conn:
+            obj = await generated.demo.create(sample_int=1)
+            await obj.update(sample_int=2)
+            await generated.demo.create_many([dict(sample_int=3)])
+            assert (await generated.demo.read(id=obj.id)).sample_int == 2
+            assert not conn.is_closed()
+            if fail:
+                raise ValueError
+
+    loop.run_until_complete(work())
+    assert len(acquires) == 1
+    with pytest.raises(ValueError):
+        loop.run_until_complete(work(fail=True))
+
+    records = loop.run_until_complete(pool.fetch('SELECT sample_int FROM demo'))
+    assert sorted(r['sample_int'] for r in records) == [2, 3]
+
+
+def test_unit_of_work(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('ALTER TABLE demo ADD COLUMN deleted_at TIMESTAMP'))
+    generated = load_generated(loop, pool, db_params)
+    a, b, c, d = loop.run_until_complete(generated.demo.create_many(
+        [dict(sample_int=i) for i in range(4)], returning=True
+    ))
+
+    async def work(fail=False):
+        async with generated.UnitOfWork() as uow:
+            uow.create(generated.demo, sample_int=10)
+            uow.create(generated.demo, sample_int=11)
+            uow.update(a, sample_int=20)
+            uow.update(a, sample_text='a')
+            uow.update(b, sample_text='b')
+            uow.delete(c)
+            uow.delete_hard(d)
+            if fail:
+                raise ValueError
+        return uow
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(work(fail=True))
+    assert a.sample_int == 0
+
+    uow = loop.run_until_complete(work())
+    assert [o.sample_int for o in uow.created[generated.demo]] == [10, 11]
+    assert (a.sample_int, a.sample_text, b.sample_text) == (20, 'a', 'b')
+    assert c.deleted_at is not None
+
+    records = loop.run_until_complete(pool.fetch(
+        'SELECT sample_int, sample_text, deleted_at IS NOT NULL AS deleted '
+        'FROM demo ORDER BY id'
+    ))
+    assert [tuple(r) for r in records] == [
+        (20, 'a', False), (1, 'b', False), (2, None, True),
+        (10, None, False), (11, None, False),
+    ]
+
+
+def test_save_changes(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    obj = loop.run_until_complete(generated.demo.create(sample_int=1, sample_text='a'))
+
+    assert obj.changes() == {}
+    assert loop.run_until_complete(obj.save()) is False
+
+    obj.sample_int = 2
+    assert obj.changes() == {'sample_int': 2}
+    assert loop.run_until_complete(obj.save()) is True
+    assert obj.changes() == {}
+    assert loop.run_until_complete(generated.demo.read(id=obj.id)).sample_int == 2
+
+    partial = loop.run_until_complete(
+        generated.demo.read(id=obj.id, columns=['sample_text'])
+    )
+    partial.sample_text = 'b'
+    assert partial.changes() == {'sample_text': 'b'}
+
+    async def unit_of_work():
+        async with generated.UnitOfWork() as uow:
+            uow.save(partial)
+
+    loop.run_until_complete(unit_of_work())
+    assert partial.changes() == {}
+    fetched = loop.run_until_complete(generated.demo.read(id=obj.id))
+    assert (fetched.sample_int, fetched.sample_text) == (2, 'b')
+
+
+def test_save_defaulted_column(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE TABLE task (
+            id SERIAL PRIMARY KEY,
+            title TEXT,
+            status TEXT NOT NULL DEFAULT 'new'
+        );
+    '''))
+    generated = load_generated(loop, pool, db_params)
+    task = generated.task
+
+    async def scenario():
+        obj = await task.create(title='t')
+        assert obj.status == 'new'
+
+        obj.status = 'done'
+        assert obj.changes() == {'status': 'done'}
+        assert await obj.save() is True
+        assert (await task.read(id=obj.id)).status == 'done'
+
+        await obj.update(status='archived')
+        assert (await task.read(id=obj.id)).status == 'archived'
+
+    loop.run_until_complete(scenario())
+
+
+def test_manifest_reuse(db_pool: asyncpg.pool.Pool, loop, tmpdir):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    outfile = str(tmpdir.join('generated_test.py'))
+    args = SimpleNamespace(outfile=outfile, db='crudtest', schema='public', **db_params)
+
+    loop.run_until_complete(pg_crud_gen.main(args))
+    first = open(outfile).read()
+    manifest = pg_crud_gen.load_manifest(pg_crud_gen.manifest_path(outfile))
+    assert 'demo' in manifest
+
+    # Unchanged schema: the stored code is reused as-is.
+    manifest['demo']['code'] = manifest['demo']['code'].replace('class demo', 'class demo_reused')
+    pg_crud_gen.save_manifest(pg_crud_gen.manifest_path(outfile), manifest)
+    loop.run_until_complete(pg_crud_gen.main(args))
+    assert 'class demo_reused' in open(outfile).read()
+
+    # A schema change invalidates the entry.
+    loop.run_until_complete(pool.execute('ALTER TABLE demo ADD COLUMN extra INT'))
+    loop.run_until_complete(pg_crud_gen.main(args))
+    second = open(outfile).read()
+    assert 'class demo_reused' not in second
+    assert 'extra' in second and 'extra' not in first
+
+
+def test_multiple_schemas(db_pool: asyncpg.pool.Pool, loop, tmpdir):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE SCHEMA other_a;
+        CREATE SCHEMA other_b;
+        CREATE TABLE other_a.thing_a (id SERIAL PRIMARY KEY, name TEXT);
+        CREATE TYPE other_a.mood AS ENUM ('calm', 'busy');
+        CREATE TABLE other_a.feeling (
+            mood other_a.mood PRIMARY KEY,
+            moods other_a.mood[],
+            note TEXT
+        );
+        CREATE TABLE other_b.thing_b (id SERIAL PRIMARY KEY, name TEXT);
+    '''))
+    outfile = str(tmpdir.join('{db}_{schema}.py'))
+    args = SimpleNamespace(
+        outfile=outfile, db='crudtest', schema='public, other_*', concurrency=2,
+        **db_params
+    )
+    loop.run_until_complete(pg_crud_gen.main(args))
+
+    for schema, table in [('public', 'demo'), ('other_a', 'thing_a'), ('other_b', 'thing_b')]:
+        with open(outfile.format(db='crudtest', schema=schema)) as f:
+            assert f'class {table}(CRUDTable)' in f.read()
+
+    # An outfile that would put several schemas in one file is refused
+    # before anything is written.
+    clashing = str(tmpdir.join('clash_{db}.py'))
+    with pytest.raises(ValueError, match='same file'):
+        loop.run_until_complete(pg_crud_gen.main(SimpleNamespace(
+            outfile=clashing, db='crudtest', schema='other_*', **db_params
+        )))
+    assert not os.path.exists(clashing.format(db='crudtest'))
+
+    # Statements name the schema, so a table of the same name earlier in
+    # the search_path is never used instead.
+    loop.run_until_complete(pool.execute(
+        'CREATE TABLE public.thing_a (id SERIAL PRIMARY KEY, name TEXT)'
+    ))
+    generated = load_generated(loop, pool, db_params, schema='other_a')
+    thing_a, feeling = generated.thing_a, generated.feeling
+
+    async def scenario():
+        created = await thing_a.create(name='x')
+        await thing_a.create_many([dict(name='y'), dict(name='z')])
+        await thing_a.create_many([dict(name='w')], returning=True)
+        await created.update(name='v')
+        assert (await thing_a.read(id=created.id)).name == 'v'
+        assert await thing_a.count() == 4
+        assert await thing_a.estimate_count() == 4
+        assert sorted(t.name for t in await thing_a.read_many()) == ['v', 'w', 'y', 'z']
+        assert await pool.fetchval('SELECT count(*) FROM public.thing_a') == 0
+
+        # So are the types in casts, which aren't on the search_path either.
+        await feeling.create_many([dict(mood='calm', moods=['busy'])], returning=True)
+        await feeling.upsert_many([dict(mood='busy', moods=[], note='n')])
+        await feeling.update_each([dict(mood='calm', note='c')])
+        found = await feeling.read_by_pks(['busy', 'calm'])
+        assert [(f.mood, f.moods, f.note) for f in found] == [
+            ('busy', [], 'n'), ('calm', ['busy'], 'c')
+        ]
+
+    loop.run_until_complete(scenario())
+
+
+def test_match_names():
+    names = ['public', 'tenant_1', 'tenant_2', 'audit']
+    assert pg_crud_gen.match_names(['tenant_*', 'public'], names) == [
+        'tenant_1', 'tenant_2', 'public'
+    ]
+    assert pg_crud_gen.split_names('a, b,,c') == ['a', 'b', 'c']
+    assert pg_crud_gen.output_path('gen.py', 'db', 's', multiple=True) == 'gen_db_s.py'
+    assert pg_crud_gen.output_path('gen.py', 'db', 's', multiple=False) == 'gen.py'
+
+
+def test_enum_code():
+    code = pg_crud_gen.generate_enum_code({'colour': ['dark blue', 'red']})
+    assert code == (
+        '# noinspection PyPep8Naming\n'
+        'class colour(Enum):\n'
+        "    dark_blue = 'dark blue'\n"
+        "    red = 'red'"
+    )
+    top = pg_crud_gen.header.format(autogentime='now', enums=code)
+    # Two blank lines before the first enum, as before any class.
+    assert '\n\n\n# noinspection PyPep8Naming\nclass colour' in top
+    assert '\n\n\n\n# noinspection PyPep8Naming\nclass colour' not in top
+
+
+def test_wrap_helpers():
+    wrap_sequence, wrap_expression = pg_crud_gen.wrap_sequence, pg_crud_gen.wrap_expression
+    assert wrap_sequence(['a'], 4, 10) == '(a,)'
+    assert wrap_sequence(['a', 'b'], 4, 10, brackets='[]') == '[a, b]'
+    items = [f'column_{i}' for i in range(8)]
+    assert wrap_sequence(items, 4, 10) == (
+        '(\n' + ''.join(f'        {item},\n' for item in items) + '    )'
+    )
+    # The prefix alone can push a short sequence onto separate lines.
+    assert wrap_sequence(['a', 'b'], 0, 74) == '(\n    a,\n    b,\n)'
+
+    assert wrap_expression(['a', 'b'], '|', 8, 10) == 'a | b'
+    terms = [f'term_{i}' for i in range(12)]
+    assert wrap_expression(terms, '|', 8, 20) == (
+        '(\n            ' + '\n            | '.join(terms) + '\n        )'
+    )
+
+    columns = [
+        pg_crud_gen.Column('a', 'int', nullstr=' = None'),
+        pg_crud_gen.Column('b', 'str'),
+    ]
+    assert pg_crud_gen.param_lines(columns) == '        a: int = None,\n        b: str,'
+    assert pg_crud_gen.param_lines(
+        columns, default=' = UNCHANGED', filter_=lambda c: c.name == 'b'
+    ) == '        b: str = UNCHANGED,'
+
+
+def test_render_table():
+    Column, Index = pg_crud_gen.Column, pg_crud_gen.Index
+    columns = OrderedDict(id=Column('id', 'int', default='nextval(...)', pgtype='int4'))
+    for i in range(12):
+        name = f'column_number_{i}'
+        columns[name] = Column(name, 'str', nullstr=' = None', pgtype='text')
+    table = pg_crud_gen.Table(
+        'wide', columns, pk='id', schema='other', indexes=[
+            Index('wide_pkey', 'wide', ['id'], True, True, 'btree'),
+            Index('wide_column_number_0_key', 'wide', ['column_number_0'], True, False, 'btree'),
+        ]
+    )
+    out = pg_crud_gen.render_table(table)
+    compile(out, 'wide.py', 'exec')
+    assert out == pg_crud_gen.render_table(table)
+    assert out.startswith('# noinspection')
+    assert "    _qualified_table = '\"other\".\"wide\"'\n" in out
+    assert "    _unique_keys = (('id',), ('column_number_0',))\n" in out
+    # Too long for one line, so one column per line.
+    assert "    _columns = (\n        'id',\n        'column_number_0',\n" in out
+    assert 'async def read_by_column_number_0(' in out
+
+
+def test_relations(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE TABLE author (id SERIAL PRIMARY KEY, name TEXT);
+        CREATE TABLE book (
+            id SERIAL PRIMARY KEY,
+            title TEXT,
+            author_id INT REFERENCES author(id)
+        );
+    '''))
+    generated = load_generated(loop, pool, db_params)
+    author, book = generated.author, generated.book
+
+    async def scenario():
+        a1 = await author.create(name='a1')
+        a2 = await author.create(name='a2')
+        await book.create_many([
+            dict(title='b1', author_id=a1.id),
+            dict(title='b2', author_id=a1.id),
+            dict(title='b3', author_id=a2.id),
+            dict(title='b4', author_id=None),
+        ])
+
+        # Loaded on access, one query per call.
+        b1 = (await book.read_many('title = $1', ['b1']))[0]
+        assert (await b1.author()).name == 'a1'
+
+        books = await book.read_many()
+        authors = await author.read_many()
+        await generated.prefetch(books, 'author')
+        await generated.prefetch(authors, 'book_set')
+
+        # Everything is attached now, so nothing else is queried.
+        generated.pool = None
+        try:
+            by_title = {b.title: (await b.author()) for b in books}
+            by_name = {a.name: sorted(b.title for b in await a.book_set()) for a in authors}
+        finally:
+            generated.pool = pool
+
+        assert {t: a and a.name for t, a in by_title.items()} == {
+            'b1': 'a1', 'b2': 'a1', 'b3': 'a2', 'b4': None
+        }
+        assert by_name == {'a1': ['b1', 'b2'], 'a2': ['b3']}
+
+        with pytest.raises(ValueError):
+            await generated.prefetch(books, 'nope')
+
+        # Changing the column drops what was loaded through it.
+        await b1.update(author_id=a2.id)
+        assert (await b1.author()).name == 'a2'
+        b1.author_id = a1.id
+        assert (await b1.author()).name == 'a1'
+        async with generated.UnitOfWork() as uow:
+            b1.author_id = None
+            uow.save(b1)
+        assert await b1.author() is None
+
+    loop.run_until_complete(scenario())
+
+
+def test_index_finders(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE TABLE account (
+            id SERIAL PRIMARY KEY,
+            email TEXT UNIQUE,
+            tenant_id INT,
+            created_at TIMESTAMP,
+            handle TEXT,
+            code TEXT UNIQUE DEFERRABLE
+        );
+        CREATE INDEX account_tenant_created_idx ON account (tenant_id, created_at);
+        CREATE INDEX account_lower_email_idx ON account (lower(email));
+        CREATE UNIQUE INDEX account_handle_idx ON account (handle) INCLUDE (email);
+    '''))
+    generated = load_generated(loop, pool, db_params)
+    account = generated.account
+    assert 'account_email_key' in account.read_by_email.__doc__
+    assert not hasattr(account, 'read_many_by_lower')
+    assert 'account_handle_idx' in account.read_by_handle.__doc__
+    assert not hasattr(account, 'read_by_code')
+
+    ts = datetime.datetime(2020, 1, 1)
+
+    async def scenario():
+        await account.create_many([
+            dict(email='a@x', tenant_id=1, created_at=ts),
+            dict(email='b@x', tenant_id=1, created_at=ts),
+            dict(email='c@x', tenant_id=2, created_at=ts),
+        ])
+        assert (await account.read_by_email(email='b@x')).tenant_id == 1
+        found = await account.read_many_by_tenant_id_created_at(
+            tenant_id=1, created_at=ts, columns=['email']
+        )
+        assert sorted(a.email for a in found) == ['a@x', 'b@x']
+
+    loop.run_until_complete(scenario())
+
+
+def test_count_exists_aggregate(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE TABLE measurement (
+            id INT,
+            region TEXT,
+            PRIMARY KEY (id, region)
+        ) PARTITION BY LIST (region);
+        CREATE TABLE measurement_north PARTITION OF measurement FOR VALUES IN ('n');
+        CREATE TABLE measurement_south PARTITION OF measurement FOR VALUES IN ('s');
+    '''))
+    generated = load_generated(loop, pool, db_params)
+    demo = generated.demo
+
+    async def scenario():
+        await demo.create_many([
+            dict(sample_text='a', sample_int=1),
+            dict(sample_text='a', sample_int=2),
+            dict(sample_text='b', sample_int=5),
+        ])
+        assert await demo.count() == 3
+        assert await demo.count('sample_text = $1', ['a']) == 2
+        assert await demo.exists('sample_int > $1', [4])
+        assert not await demo.exists('sample_int > $1', [5])
+
+        totals = await demo.aggregate({'n': 'count', 'top': ('max', 'sample_int')})
+        assert (totals['n'], totals['top']) == (3, 5)
+
+        groups = await demo.aggregate(
+            {'n': 'count', 'total': ('sum', 'sample_int')}, group_by='sample_text'
+        )
+        assert [tuple(g) for g in groups] == [('a', 2, 3), ('b', 1, 5)]
+
+        with pytest.raises(ValueError):
+            await demo.aggregate({'x': ('sum', 'nope')})
+        with pytest.raises(ValueError):
+            await demo.aggregate({'x': ('drop table', 'sample_int')})
+
+        await pool.execute('ANALYZE demo')
+        assert await demo.estimate_count() == 3
+
+        measurement = generated.measurement
+        assert await measurement.estimate_count() == 0
+        await measurement.create_many([dict(id=i, region='ns'[i % 2]) for i in range(10)])
+        # As autovacuum would, analyze the partitions but not the parent.
+        await pool.execute('ANALYZE measurement_north, measurement_south')
+        await measurement.create_many([dict(id=i, region='n') for i in range(10, 15)])
+        # The estimate only moves with ANALYZE, unlike count().
+        assert await measurement.estimate_count() == 10
+
+    loop.run_until_complete(scenario())
+
+
+def test_export(db_pool: asyncpg.pool.Pool, loop, tmpdir):
+    import json
+
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    demo = generated.demo
+
+    async def scenario():
+        await demo.create_many([
+            dict(sample_text='plain', sample_int=1),
+            dict(sample_text='with "quotes", \\backslash\nand newline', sample_int=2),
+        ])
+
+        path = str(tmpdir.join('demo.csv'))
+        assert await demo.export(output=path, columns=['sample_int', 'sample_text']) == 2
+        with open(path) as f:
+            assert f.readline() == 'sample_int,sample_text\n'
+
+        chunks = []
+
+        async def sink(data):
+            chunks.append(data)
+
+        n = await demo.export('sample_int > $1', [1], fmt='jsonl', output=sink)
+        assert n == 1
+        rows = [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+        assert rows[0]['sample_text'] == 'with "quotes", \\backslash\nand newline'
+
+        path = str(tmpdir.join('demo.bin'))
+        assert await demo.export(output=path, fmt='binary') == 2
+        with open(path, 'rb') as f:
+            assert f.read(11) == b'PGCOPY\n\xff\r\n\x00'
+
+        with pytest.raises(ValueError):
+            await demo.export(output=path, fmt='xml')
+
+    loop.run_until_complete(scenario())
+
+
+def test_read_columns(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE TABLE reading (
+            id SERIAL PRIMARY KEY,
+            value DOUBLE PRECISION,
+            count INT,
+            taken_at TIMESTAMPTZ,
+            tags TEXT[],
+            samples NUMERIC[]
+        );
+    '''))
+    generated = load_generated(loop, pool, db_params)
+    reading = generated.reading
+    ts = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    async def scenario():
+        await reading.create_many([
+            dict(value=1.5, count=1, taken_at=ts, tags=['a'], samples=[Decimal('0.1')]),
+            dict(value=2.5, count=None, taken_at=None, tags=['b', 'c'], samples=[]),
+            dict(value=3.5, count=3, taken_at=ts, tags=None, samples=[Decimal('1'), None]),
+        ])
+        cols = await reading.read_columns('id > $1', [0], columns=['count', 'tags', 'samples'])
+        assert cols == {
+            'count': [1, None, 3],
+            'tags': [['a'], ['b', 'c'], None],
+            'samples': [[Decimal('0.1')], [], [Decimal('1'), None]],
+        }
+        assert isinstance(cols['samples'][0][0], Decimal)
+
+        empty = await reading.read_columns('id < $1', [0])
+        assert empty['value'] == []
+
+        np = pytest.importorskip('numpy')
+        cols = await reading.read_columns(numpy=True)
+        assert cols['value'].dtype == np.float64
+        assert cols['count'].dtype == np.float64 and np.isnan(cols['count'][1])
+        assert cols['taken_at'][0] == np.datetime64('2020-01-01T00:00:00')
+        assert np.isnat(cols['taken_at'][1])
+        assert cols['id'].dtype == np.int64
+
+    loop.run_until_complete(scenario())
+
+
+def test_instrumentation_hooks(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    demo = generated.demo
+    before, after = [], []
+    histogram = generated.LatencyHistogram()
+
+    async def scenario():
+        generated.add_hooks(before=before.append, after=after.append)
+        generated.add_hooks(after=histogram)
+        try:
+            obj = await demo.create(sample_int=1)
+            await demo.read(id=obj.id)
+            await demo.update_many(where_clause='id = $1', where_params=[obj.id], sample_int=2)
+            with pytest.raises(asyncpg.PostgresError):
+                await demo.read_many('nope = 1')
+        finally:
+            generated.remove_hooks(before=before.append, after=after.append)
+            generated.remove_hooks(after=histogram)
+        await demo.read(id=obj.id)
+
+    loop.run_until_complete(scenario())
+
+    assert [(e.table, e.op) for e in after] == [
+        ('demo', 'create'), ('demo', 'read'), ('demo', 'update_many'), ('demo', 'read_many')
+    ]
+    assert len(before) == 4
+    create, read, update, failed = after
+    assert 'INSERT INTO "public"."demo"' in create.sql and create.rows == 1
+    assert update.rows == 1
+    assert all(e.elapsed >= 0 and e.wait >= 0 for e in after)
+    assert failed.error is not None and failed.rows is None
+
+    summary = histogram.summary()
+    assert summary['demo', 'read']['count'] == 1
+    assert summary['demo', 'read_many']['errors'] == 1
+    assert summary['demo', 'read']['p99'] <= summary['demo', 'read']['max']
+
+
+def test_explain_slow_queries(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    generated = load_generated(loop, pool, db_params)
+    demo = generated.demo
+    plans = []
+
+    async def report(event, plan):
+        plans.append((event.op, event.params, plan))
+
+    explainer = generated.ExplainSlowQueries(report, threshold=0.0, min_interval=0.0)
+
+    async def scenario():
+        await demo.create(sample_int=1)
+        generated.add_hooks(after=explainer)
+        try:
+            await demo.read_many('sample_int = $1', [1])
+            await asyncio.gather(*generated._background_tasks)
+            await demo.update_many(where_clause='sample_int = $1', where_params=[1], sample_int=2)
+            await asyncio.gather(*generated._background_tasks)
+
+            # COPY is never explained, since that would run the export again.
+            async def discard(chunk):
+                pass
+
+            await demo.export('sample_int = $1', [2], output=discard)
+            await asyncio.gather(*generated._background_tasks)
+
+            # Below the threshold, or not sampled: nothing is explained.
+            explainer.threshold = 60
+            await demo.read_many()
+            explainer.threshold, explainer.sample_rate = 0.0, 0.0
+            await demo.read_many()
+            await asyncio.gather(*generated._background_tasks)
+        finally:
+            generated.remove_hooks(after=explainer)
+
+    loop.run_until_complete(scenario())
+
+    assert explainer.last_error is None
+    assert [(op, params) for op, params, _ in plans] == [
+        ('read_many', (1,)), ('update_many', (1, 2))
+    ]
+    assert 'actual time' in plans[0][2] and 'Buffers' in plans[0][2]
+    assert 'Update on demo' in plans[1][2] and 'actual' not in plans[1][2]
+    assert loop.run_until_complete(demo.count('sample_int = $1', [2])) == 1
+
+
+def test_columns_named_like_locals(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE TABLE clash (
+            id SERIAL PRIMARY KEY,
+            mask TEXT,
+            sql TEXT,
+            fieldnames TEXT,
+            set_clause TEXT,
+            conn TEXT UNIQUE
+        );
+    '''))
+    generated = load_generated(loop, pool, db_params)
+    clash = generated.clash
+
+    async def scenario():
+        obj = await clash.create(conn='c')
+        await obj.update(mask='255.255.255.0', sql='select 1', fieldnames='f')
+        await clash.update_many(
+            where_clause='id = $1', where_params=[obj.id], set_clause='s'
+        )
+        fetched = await clash.read_by_conn(conn='c')
+        assert (fetched.mask, fetched.sql, fetched.fieldnames, fetched.set_clause) == (
+            '255.255.255.0', 'select 1', 'f', 's'
+        )
+
+    loop.run_until_complete(scenario())
+
+
+def test_bulk_array_columns(db_pool: asyncpg.pool.Pool, loop):
+    pool, db_params = db_pool
+    loop.run_until_complete(make_table(pool))
+    loop.run_until_complete(pool.execute('''\
+        CREATE TABLE post (
+            id SERIAL PRIMARY KEY,
+            slug TEXT UNIQUE,
+            tags TEXT[]
+        );
+    '''))
+    generated = load_generated(loop, pool, db_params)
+    post = generated.post
+
+    async def scenario():
+        created = await post.create_many([
+            dict(slug='a', tags=['x']),
+            dict(slug='b', tags=['x', 'y', 'z']),
+            dict(slug='c', tags=[]),
+        ], returning=True)
+        assert [p.tags for p in created] == [['x'], ['x', 'y', 'z'], []]
+
+        count = await post.update_each(
+            [dict(id=created[0].id, tags=['p', 'q']), dict(id=created[2].id, tags=['r'])]
+        )
+        assert count == 2
+
+        upserted = await post.upsert_many([
+            dict(slug='b', tags=['y']),
+            dict(slug='d', tags=['s', 't']),
+        ], returning=True, chunk_size=1)
+        assert [p.tags for p in upserted] == [['y'], ['s', 't']]
+
+        rows = await post.read_many('TRUE ORDER BY slug')
+        assert [(p.slug, p.tags) for p in rows] == [
+            ('a', ['p', 'q']), ('b', ['y']), ('c', ['r']), ('d', ['s', 't']),
+        ]
+
+    loop.run_until_complete(scenario())